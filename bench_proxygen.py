@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Owl Proxy Bot benchmark
+Drives proxygen.py's Application handlers with fake Telegram updates against a
+local stand-in for the Owl Proxy API, then reports throughput and latency.
+
+No real traffic is spent and no Telegram connection is made:
+  * FakeOwlAPI serves queryCurrentTrafficBalance and createProxy on localhost
+    with configurable latency, error rate and balance depletion.
+  * FakeTelegramRequest answers the Bot API calls the handlers make.
+
+Example:
+    python bench_proxygen.py --tokens 20 --requests 500 --concurrency 50 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+# proxygen opens its SQLite file in the working directory at import time,
+# so move somewhere disposable before importing it
+os.chdir(tempfile.mkdtemp(prefix="proxygen_bench_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import proxygen  # noqa: E402
+
+logger = logging.getLogger("bench")
+
+BENCH_BOT_TOKEN = "123456:BENCHMARK"
+BENCH_BOT_ID = 123456
+
+
+class FakeOwlAPI:
+    """Minimal HTTP/1.1 keep-alive server imitating the two Owl Proxy endpoints"""
+
+    def __init__(self, latency: float = 0.1, jitter: float = 0.05, error_rate: float = 0.0,
+                 balance: int = 10_000, mb_per_proxy: float = 1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.initial_balance = balance
+        self.mb_per_proxy = mb_per_proxy
+        self.balances: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {'queryCurrentTrafficBalance': 0, 'createProxy': 0}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.port: Optional[int] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/owlproxy/api/vcDynamicGood"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _respond(self, endpoint: str, headers: Dict[str, str], body: bytes) -> Tuple[int, Dict]:
+        token = headers.get('token', '')
+        balance = self.balances.setdefault(token, self.initial_balance)
+
+        if random.random() < self.error_rate:
+            return (503, {}) if random.random() < 0.5 else (200, {'code': 500, 'msg': 'Simulated failure'})
+
+        if endpoint == 'queryCurrentTrafficBalance':
+            return 200, {'code': 200, 'data': {'remainingTraffic': int(balance)}}
+
+        if endpoint == 'createProxy':
+            payload = json.loads(body or b'{}')
+            good_num = int(payload.get('goodNum', 1))
+            if balance < 50:
+                return 200, {'code': 500, 'msg': 'Insufficient traffic'}
+            self.balances[token] = balance - good_num * self.mb_per_proxy
+            proxies = [
+                {
+                    'proxyType': payload.get('proxyType', 'socks5'),
+                    'proxyHost': 'change4.owlproxy.com',
+                    'proxyPort': 7778,
+                    'userName': f"bench-{payload.get('countryCode', 'XX')}-{random.getrandbits(32):08x}",
+                    'password': 'bench',
+                }
+                for _ in range(good_num)
+            ]
+            return 200, {'code': 200, 'data': proxies}
+
+        return 404, {}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+
+                endpoint = request_line.split()[1].decode().rsplit('/', 1)[-1]
+                if endpoint in self.calls:
+                    self.calls[endpoint] += 1
+
+                await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+                status, payload = self._respond(endpoint, headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally so handlers can run without Telegram"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method == 'getMe':
+            result = {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif api_method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+            if api_method == 'sendDocument':
+                result['document'] = {'file_id': f'doc{self._message_id}', 'file_unique_id': f'u{self._message_id}'}
+        else:
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateDriver:
+    """Builds fake command updates and feeds them through Application.process_update"""
+
+    def __init__(self, application):
+        self.application = application
+        self._update_id = 0
+
+    def command(self, user_id: int, text: str) -> Update:
+        self._update_id += 1
+        command = text.split()[0]
+        data = {
+            'update_id': self._update_id,
+            'message': {
+                'message_id': self._update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+            },
+        }
+        return Update.de_json(data, self.application.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        self._update_id += 1
+        payload = {
+            'update_id': self._update_id,
+            'callback_query': {
+                'id': str(self._update_id),
+                'chat_instance': 'bench',
+                'data': data,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'Bench'},
+                    'text': 'list',
+                },
+            },
+        }
+        return Update.de_json(payload, self.application.bot)
+
+    async def run(self, make_update, total: int, concurrency: int) -> Tuple[List[float], float]:
+        """Process `total` updates with at most `concurrency` in flight; returns latencies and wall time"""
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: List[float] = []
+
+        async def one(i: int):
+            async with semaphore:
+                update = make_update(i)
+                started = time.perf_counter()
+                await self.application.process_update(update)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return latencies, time.perf_counter() - started
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(name: str, latencies: List[float], wall: float):
+    print(
+        f"{name:<10} n={len(latencies):<5} {len(latencies) / wall:8.1f} req/s   "
+        f"p50 {percentile(latencies, 0.50) * 1000:7.1f} ms   "
+        f"p95 {percentile(latencies, 0.95) * 1000:7.1f} ms   "
+        f"p99 {percentile(latencies, 0.99) * 1000:7.1f} ms   "
+        f"mean {statistics.fmean(latencies) * 1000 if latencies else 0:7.1f} ms"
+    )
+
+
+async def run_benchmark(args):
+    api = FakeOwlAPI(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                     balance=args.balance, mb_per_proxy=args.mb_per_proxy)
+    await api.start()
+    proxygen.BALANCE_ENDPOINT = f"{api.base_url}/queryCurrentTrafficBalance"
+    proxygen.CREATE_PROXY_ENDPOINT = f"{api.base_url}/createProxy"
+
+    telegram_request = FakeTelegramRequest(latency=args.telegram_latency)
+    application = proxygen.build_application(BENCH_BOT_TOKEN, request=telegram_request)
+    await application.initialize()
+    await application.post_init(application)
+
+    for i in range(args.tokens):
+        await proxygen.registry.add(f"bench-token-{i:04d}", f"bench-user-{i:04d}")
+
+    driver = UpdateDriver(application)
+    countries = [c.strip().upper() for c in args.countries.split(',')]
+
+    print(f"Owl API stand-in on port {api.port}: latency {args.latency * 1000:.0f} ms, "
+          f"error rate {args.error_rate:.0%}, {args.tokens} token(s)")
+    print()
+
+    try:
+        latencies, wall = await driver.run(
+            lambda i: driver.command(1_000_000 + i % args.users, f"/get {random.choice(countries)} {args.count}"),
+            args.requests, args.concurrency
+        )
+        report('/get', latencies, wall)
+
+        latencies, wall = await driver.run(
+            lambda i: driver.command(proxygen.ADMIN_USER_ID, '/checkall'), args.checkall, 1
+        )
+        report('/checkall', latencies, wall)
+
+        latencies, wall = await driver.run(
+            lambda i: driver.command(2_000_000 + i % args.users, '/list')
+            if i % 2 == 0 else driver.callback(2_000_000 + i % args.users, f"page_{1 + i % proxygen.COUNTRY_TOTAL_PAGES}"),
+            args.requests, args.concurrency
+        )
+        report('/list', latencies, wall)
+    finally:
+        await application.shutdown()
+        await application.post_shutdown(application)
+        await api.stop()
+
+    print()
+    print(f"Upstream calls: {api.calls}")
+    print(f"Telegram calls: {dict(sorted(telegram_request.calls.items()))}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark proxygen.py against local fakes")
+    parser.add_argument('--requests', type=int, default=200, help="/get and /list updates to send")
+    parser.add_argument('--concurrency', type=int, default=20, help="updates processed at once")
+    parser.add_argument('--users', type=int, default=100, help="distinct fake users sending updates")
+    parser.add_argument('--count', type=int, default=5, help="proxies per /get")
+    parser.add_argument('--countries', default="US,IN,GB,DE,FR", help="comma-separated countries for /get")
+    parser.add_argument('--checkall', type=int, default=3, help="/checkall runs")
+    parser.add_argument('--tokens', type=int, default=10, help="tokens loaded into the registry")
+    parser.add_argument('--latency', type=float, default=0.1, help="mean fake API latency (s)")
+    parser.add_argument('--jitter', type=float, default=0.03, help="fake API latency std-dev (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of fake API calls that fail")
+    parser.add_argument('--balance', type=int, default=100_000, help="starting MB per token")
+    parser.add_argument('--mb-per-proxy', type=float, default=1.0, help="MB the fake API debits per proxy")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="fake Bot API latency (s)")
+    parser.add_argument('--verbose', action='store_true', help="keep proxygen's INFO logging")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,31 @@ Manages proxy tokens and provides automated balance checking with proxy generati
 """
 
 import asyncio
+import cProfile
+import csv
+import difflib
+import io
+import html
 import logging
+import os
+import pstats
+import random
+import socket
 import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
 import httpx
-from datetime import datetime
-from functools import lru_cache
-from typing import Optional, Tuple, List, Dict
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from functools import partial, wraps
+from typing import Any, Optional, Tuple, List, Dict
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import RetryAfter
+from telegram.helpers import escape_markdown
 from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
@@ -231,6 +249,11 @@ COUNTRY_LIST = [
         ("🇿🇼", "Zimbabwe", "ZW", "English"),
     ]
 
+# Country lookups, built once at import
+COUNTRY_INDEX: Dict[str, Tuple[str, str, str, str]] = {entry[2]: entry for entry in COUNTRY_LIST}
+COUNTRY_NAME_INDEX: Dict[str, str] = {entry[1].lower(): entry[2] for entry in COUNTRY_LIST}
+COUNTRY_PAGE_SIZE = 20  # Countries per /list page
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -242,10 +265,17 @@ logger = logging.getLogger(__name__)
 ADMIN_USER_ID = 7613349080  # Only this user can add tokens
 
 # Conversation states
-TOKEN_INPUT, USERID_INPUT = range(2)
+TOKEN_INPUT, USERID_INPUT, IMPORT_FILE = range(3)
 
 # Database file
 DB_FILE = "proxy_tokens.db"
+SQLITE_BUSY_TIMEOUT = 10.0  # Seconds to wait when another instance holds the write lock
+
+# Multi-instance coordination: several bot processes on one host may share DB_FILE
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+TOKEN_LEASE_SECONDS = 300  # A claimed token is released after this long even if its holder died
+SWEEP_LOCK_SECONDS = 120  # Balance sweep ownership, renewed while the sweep is running
+REGISTRY_REFRESH_INTERVAL = 30  # Seconds between re-reads of tokens changed by other instances
 
 # API Configuration
 API_BASE_URL = "https://api.owlproxy.com/owlproxy/api/vcDynamicGood"
@@ -258,17 +288,394 @@ DEFAULT_HEADERS = {
     'Referer': 'https://proxy.owlproxy.com/'
 }
 
+# HTTP client configuration (one pooled client is shared by all API calls)
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_EXPIRY = 60.0  # Seconds an idle connection is kept warm
+HTTP2_ENABLED = True  # Only takes effect when the optional `h2` package is installed
+
+# Upstream resilience: short timeouts, jittered retries and circuit breakers
+API_CONNECT_TIMEOUT = 5.0
+BALANCE_TIMEOUT = 15.0
+CREATE_PROXY_TIMEOUT = 45.0
+API_MAX_RETRIES = 2  # Extra attempts after a transient failure
+API_BACKOFF_BASE = 0.5  # Seconds; doubles per attempt, randomized with full jitter
+API_BACKOFF_MAX = 5.0
+API_AUTH_ERROR_CODES = (401, 403)  # Response codes that mean the token itself is unusable
+BREAKER_FAILURE_THRESHOLD = 5  # Consecutive failures that open a circuit
+BREAKER_RESET_TIMEOUT = 30.0  # Seconds an open circuit fails fast before trying again
+
+# Token health: tokens that keep failing or answer slowly are quarantined and re-probed later
+HEALTH_WINDOW = 20  # Recent calls kept per token for the success rate
+HEALTH_MIN_SAMPLES = 5  # Calls needed before a token can be quarantined
+HEALTH_MIN_SUCCESS_RATE = 0.5
+HEALTH_MAX_LATENCY = 20.0  # Seconds (smoothed) above which a token is considered unhealthy
+QUARANTINE_BASE = 300  # Seconds for a first quarantine; doubles on every failed re-probe
+QUARANTINE_MAX = 6 * 3600
+
+# Token selection: "round_robin", "balance" (highest remaining first) or "least_inflight"
+TOKEN_SELECTION_POLICY = "round_robin"
+MAX_TOKEN_ATTEMPTS = 3  # Tokens tried per /get before giving up
+ORDER_SPLIT_SIZE = 10  # Larger /get orders are split into concurrent createProxy calls of this size
+
+# Request coalescing: concurrent small same-country orders share one createProxy call
+COALESCE_ENABLED = True
+COALESCE_WINDOW = 0.05  # Seconds a request waits for others to join its batch
+UPSTREAM_MAX_GOOD_NUM = 50  # Most proxies a single createProxy call may ask for
+
+# Local traffic accounting: /get only re-checks a token's balance when the estimate needs it
+ESTIMATED_MB_PER_PROXY = 1.0  # Traffic assumed to be used per generated proxy
+RECONCILE_INTERVAL = 600  # Seconds before an estimate is re-checked against the API anyway
+RECONCILE_MARGIN = 50  # Re-check once the estimate is within this many MB of the threshold
+
+# Adaptive balance polling: busy or nearly empty tokens are checked more often than idle ones
+POLL_TICK = 60  # Seconds between scheduler passes looking for due tokens
+POLL_MIN_INTERVAL = 120  # Shortest time between checks of one token
+POLL_MAX_INTERVAL = 6 * 3600  # Longest time an idle token goes unchecked
+POLL_HEADROOM_FRACTION = 0.25  # Check again after this share of the projected time to the threshold
+POLL_JITTER = 0.2  # Random +/- share applied to each interval so checks don't line up
+BURN_RATE_SMOOTHING = 0.3  # Weight of the newest reading in the burn-rate moving average
+
+# Generated proxy credentials are valid for this long ("time" in the createProxy payload)
+PROXY_SESSION_MINUTES = 5
+
+# Warm proxy pool: proxies pre-generated in the background for popular countries
+WARM_POOL_ENABLED = False
+WARM_POOL_COUNTRIES = ("IN", "US", "GB", "DE", "FR")
+WARM_POOL_SIZE = 10  # Proxies kept ready per country
+WARM_POOL_REFILL_INTERVAL = 30  # Seconds between background refill passes
+WARM_POOL_EXPIRY_MARGIN = 90  # Pooled proxies are discarded this many seconds before they expire
+
+# Delivery: big orders are sent as one file, everything else through a rate-limited send queue
+DELIVERY_DOCUMENT_THRESHOLD = 15  # Orders above this many proxies are sent as a document
+DELIVERY_DOCUMENT_FORMAT = "txt"  # "txt" or "csv"
+SEND_QUEUE_GLOBAL_RATE = 25  # Messages per second across all chats (Telegram allows about 30)
+SEND_QUEUE_CHAT_RATE = 1.0  # Sustained messages per second to one chat
+SEND_QUEUE_CHAT_BURST = 5  # Messages one chat may receive back to back
+SEND_QUEUE_MAX_RETRIES = 2  # Retries after a flood-control (RetryAfter) error
+
+# Metrics: shown by /metrics and optionally exported as Prometheus text
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+METRICS_TEXTFILE = None  # e.g. "proxygen.prom"; rewritten every METRICS_EXPORT_INTERVAL seconds
+METRICS_EXPORT_INTERVAL = 15
+METRICS_PORT = None  # e.g. 9108 to serve http://127.0.0.1:9108/metrics
+METRICS_HOST = "127.0.0.1"
+
+# Update delivery: long polling by default, webhook when WEBHOOK_URL is set
+# (webhook mode needs `pip install "python-telegram-bot[webhooks]"`)
+WEBHOOK_URL = None  # Public HTTPS base URL Telegram posts to, e.g. "https://bot.example.com"
+WEBHOOK_LISTEN = "127.0.0.1"  # Local listener address; put a TLS reverse proxy in front of it
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"  # URL path Telegram posts updates to
+WEBHOOK_SECRET_TOKEN = None  # Checked against X-Telegram-Bot-Api-Secret-Token when set
+WEBHOOK_MAX_CONNECTIONS = 40  # Parallel connections Telegram may open to the webhook
+CONCURRENT_UPDATES = 32  # Updates handled at once (1 processes them strictly in order)
+
+# Balance sweep configuration
+LOW_BALANCE_THRESHOLD = 50  # Tokens below this many MB are removed
+SWEEP_CONCURRENCY = 10  # Balance checks in flight at once
+SWEEP_PROGRESS_INTERVAL = 3.0  # Minimum seconds between /checkall progress edits
+
+# Write-behind: balance readings and low-balance removals are buffered and written in one transaction
+WRITE_BEHIND_INTERVAL = 5.0  # Most seconds of changes a crash can lose; 0 writes every change at once
+WRITE_BEHIND_MAX_PENDING = 500  # Flush early once this many changes are buffered
+
+# Balance history: raw readings are rolled up into hourly and daily consumption totals
+HISTORY_ROLLUP_INTERVAL = 3600  # Seconds between rollup/compaction runs
+HISTORY_RAW_RETENTION_DAYS = 7  # Raw readings kept after being rolled up
+HISTORY_HOURLY_RETENTION_DAYS = 90  # Hourly rollups kept; daily rollups are kept forever
+TRENDS_DEFAULT_DAYS = 7  # Window shown by /trends
+
+# Orders ledger: one row per /get, written in the background
+ORDER_LEDGER_FLUSH_INTERVAL = 5.0  # Seconds between ledger writes
+ORDER_EXPORT_CHUNK = 1000  # Rows read per query while exporting
+ORDER_EXPORT_DEFAULT_DAYS = 30  # Window exported by /orders
+ORDER_EXPORT_SPOOL_BYTES = 1024 * 1024  # The CSV moves from memory to a temp file above this size
+
+# /get scheduling: orders share upstream capacity fairly across users
+GET_MAX_CONCURRENT_ORDERS = 8  # Orders being generated at once across all users
+GET_USER_MAX_CONCURRENT = 1  # Orders one user may have generating at once; extra ones queue
+GET_USER_PROXY_RATE = 100 / 60  # Proxies per second a user's quota refills by
+GET_USER_PROXY_BURST = 100  # Proxies a user may order back to back
+GET_QUOTA_MAX_WAIT = 30.0  # Orders that would wait longer than this for quota are refused
+GET_QUEUE_UPDATE_INTERVAL = 5.0  # Seconds between queue position updates
+
+# /profile: runtime profiling windows; nothing is installed while no window is open
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP_FUNCTIONS = 40  # Functions listed per thread, by cumulative time
+PROFILE_TRACEMALLOC_FRAMES = 10  # Stack depth recorded per allocation
+PROFILE_TOP_ALLOCATIONS = 25
+PROFILE_SLOW_CALLBACK = 0.1  # Seconds a loop callback may run before it is reported
+
+# Bulk token import (/import)
+IMPORT_MAX_BYTES = 1024 * 1024  # Largest accepted upload
+IMPORT_CONCURRENCY = SWEEP_CONCURRENCY  # Balance checks in flight at once while validating
+IMPORT_REPORT_LINES = 30  # Rejected lines listed individually in the summary
+
+# /showall pages
+SHOWALL_PAGE_SIZE = 10  # Tokens per page
+SHOWALL_LOW_BALANCE = 200  # MB at or below which a checked token shows under the "low" filter
+SHOWALL_STALE_SECONDS = POLL_MAX_INTERVAL  # Tokens not checked for this long show under "stale"
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram (Prometheus style)"""
+    
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+    
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if seen + count >= rank and count:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Counters, latency histograms and gauges, keyed by name plus labels"""
+    
+    def __init__(self):
+        self.counters: Dict[Tuple, float] = {}
+        self.histograms: Dict[Tuple, Histogram] = {}
+        self.gauges: Dict[Tuple, float] = {}
+        self._gauge_funcs: Dict[str, Any] = {}
+    
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> Tuple:
+        return (name,) + tuple(sorted(labels.items()))
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+    
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = self._key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+    
+    def register_gauge(self, name: str, func):
+        """Report `func()` as the gauge's value whenever metrics are rendered"""
+        self._gauge_funcs[name] = func
+    
+    @contextmanager
+    def track(self, histogram: str, in_flight: Optional[str] = None, **labels):
+        """Time a block into `histogram` and count it in the `in_flight` gauge while it runs"""
+        if in_flight:
+            self.add_gauge(in_flight, 1, **labels)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(histogram, time.perf_counter() - started, **labels)
+            if in_flight:
+                self.add_gauge(in_flight, -1, **labels)
+    
+    def _all_gauges(self) -> Dict[Tuple, float]:
+        gauges = dict(self.gauges)
+        for name, func in self._gauge_funcs.items():
+            try:
+                gauges[(name,)] = func()
+            except Exception as e:
+                logger.warning(f"Error reading gauge {name}: {e}")
+        return gauges
+    
+    @staticmethod
+    def _format_labels(key: Tuple, extra: str = '') -> str:
+        parts = [f'{k}="{v}"' for k, v in key[1:]]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+    
+    def render_prometheus(self) -> str:
+        """Render everything in the Prometheus text exposition format"""
+        lines = []
+        typed = set()
+        
+        def type_line(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE proxygen_{name} {kind}")
+        
+        for key, value in sorted(self.counters.items()):
+            type_line(key[0], 'counter')
+            lines.append(f"proxygen_{key[0]}{self._format_labels(key)} {value}")
+        for key, value in sorted(self._all_gauges().items()):
+            type_line(key[0], 'gauge')
+            lines.append(f"proxygen_{key[0]}{self._format_labels(key)} {value}")
+        for key, hist in sorted(self.histograms.items()):
+            type_line(key[0], 'histogram')
+            cumulative = 0
+            for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"proxygen_{key[0]}_bucket{self._format_labels(key, le)} {cumulative}")
+            lines.append(f"proxygen_{key[0]}_sum{self._format_labels(key)} {hist.sum:.6f}")
+            lines.append(f"proxygen_{key[0]}_count{self._format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+    
+    def render_summary(self) -> str:
+        """Compact plain-text overview for the /metrics command"""
+        def name_of(key: Tuple) -> str:
+            labels = ','.join(f"{k}={v}" for k, v in key[1:])
+            return f"{key[0]}[{labels}]" if labels else key[0]
+        
+        lines = ["Latency (count  p50 / p95 / p99)"]
+        for key, hist in sorted(self.histograms.items()):
+            lines.append(
+                f"  {name_of(key)}: {hist.count}  "
+                f"{hist.quantile(0.5) * 1000:.0f} / {hist.quantile(0.95) * 1000:.0f} / {hist.quantile(0.99) * 1000:.0f} ms"
+            )
+        lines.append("")
+        lines.append("Counters")
+        for key, value in sorted(self.counters.items()):
+            lines.append(f"  {name_of(key)}: {value:g}")
+        lines.append("")
+        lines.append("Gauges")
+        for key, value in sorted(self._all_gauges().items()):
+            lines.append(f"  {name_of(key)}: {value:g}")
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+def instrumented(name: str):
+    """Decorator timing a handler into handler_seconds and counting it in handler_in_flight"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            with metrics.track('handler_seconds', 'handler_in_flight', handler=name):
+                return await func(update, context)
+        return wrapper
+    return decorator
+
+
+class MetricsExporter:
+    """Publishes Prometheus text to METRICS_TEXTFILE and/or an HTTP listener on METRICS_PORT"""
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+    
+    @staticmethod
+    def _write_textfile(content: str):
+        # Write then rename so scrapers never read a half-written file
+        tmp_path = f"{METRICS_TEXTFILE}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, METRICS_TEXTFILE)
+    
+    async def _textfile_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self._write_textfile, metrics.render_prometheus())
+            except Exception as e:
+                logger.error(f"Error writing metrics file: {e}")
+            await asyncio.sleep(METRICS_EXPORT_INTERVAL)
+    
+    @staticmethod
+    async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # Skip headers
+            path = request_line.split()[1].decode() if len(request_line.split()) > 1 else ''
+            if path == '/metrics':
+                status, body = '200 OK', metrics.render_prometheus().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+    
+    async def start(self):
+        if METRICS_TEXTFILE and self._task is None:
+            self._task = asyncio.create_task(self._textfile_loop())
+            logger.info(f"Writing metrics to {METRICS_TEXTFILE}")
+        if METRICS_PORT and self._server is None:
+            self._server = await asyncio.start_server(self._handle_http, METRICS_HOST, METRICS_PORT)
+            logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics_exporter = MetricsExporter()
+
+
+def timestamp_now() -> str:
+    """Current time in the format stored in the last_checked column"""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
 
 class Database:
-    """Handle all database operations"""
+    """Handle all database operations
+    
+    SQLite is blocking, so one persistent connection lives on a dedicated
+    worker thread and every public method is awaitable. Queries never run on
+    the event loop thread.
+    """
     
     def __init__(self, db_file: str = DB_FILE):
         self.db_file = db_file
-        self.init_db()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._executor.submit(self.init_db).result()
+    
+    def _connection(self) -> sqlite3.Connection:
+        """Return the persistent connection (worker thread only)"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, timeout=SQLITE_BUSY_TIMEOUT)
+        return self._conn
     
     def init_db(self):
         """Initialize the database with required table"""
-        conn = sqlite3.connect(self.db_file)
+        conn = self._connection()
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS tokens (
@@ -280,165 +687,769 @@ class Database:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(tokens)')}
+        if 'lease_owner' not in columns:
+            cursor.execute('ALTER TABLE tokens ADD COLUMN lease_owner TEXT')
+        if 'lease_expires' not in columns:
+            cursor.execute('ALTER TABLE tokens ADD COLUMN lease_expires REAL')
+        # Append-only balance readings; consumed is the drop since the previous reading
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS balance_history (
+                token_id INTEGER NOT NULL,
+                checked_at TEXT NOT NULL,
+                remaining_traffic INTEGER NOT NULL,
+                consumed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (token_id, checked_at)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_balance_history_checked_at ON balance_history (checked_at)')
+        # granularity is "hour" or "day"; bucket_start is "YYYY-MM-DD HH:00:00"
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS balance_rollups (
+                granularity TEXT NOT NULL,
+                token_id INTEGER NOT NULL,
+                bucket_start TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                consumed INTEGER NOT NULL,
+                last_traffic INTEGER NOT NULL,
+                last_checked TEXT NOT NULL,
+                PRIMARY KEY (granularity, token_id, bucket_start)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_balance_rollups_bucket ON balance_rollups (granularity, bucket_start)')
+        # tokens lists the tokens that filled the order as "id:count;id:count"
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                country_code TEXT NOT NULL,
+                requested INTEGER NOT NULL,
+                delivered INTEGER NOT NULL,
+                outcome TEXT NOT NULL,
+                tokens TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        ''')
         cursor.execute('PRAGMA journal_mode=WAL;')
         cursor.execute('PRAGMA synchronous=NORMAL;')
         conn.commit()
-        conn.close()
         logger.info("Database initialized")
     
-    def add_token(self, token: str, userid: str) -> bool:
-        """Add a new token and userid to the database"""
+    def _query(self, sql: str, params=(), fetch: Optional[str] = None, many: bool = False):
+        """Run one statement on the worker thread, committing writes
+        
+        Returns the fetched row(s) when `fetch` is "one" or "all", the new row id
+        when it is "lastrowid", otherwise the number of affected rows.
+        """
+        conn = self._connection()
+        try:
+            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            if fetch == 'one':
+                return cursor.fetchone()
+            if fetch == 'all':
+                return cursor.fetchall()
+            conn.commit()
+            if fetch == 'lastrowid':
+                return cursor.lastrowid
+            return cursor.rowcount
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _query_each(self, sql: str, params_list, fetch: Optional[str] = None) -> List[int]:
+        """Run one statement per parameter tuple in a single transaction
+        
+        Returns each statement's new row id when `fetch` is "lastrowid",
+        otherwise each rowcount.
+        """
+        conn = self._connection()
+        try:
+            cursors = [conn.execute(sql, params) for params in params_list]
+            conn.commit()
+            if fetch == 'lastrowid':
+                return [cursor.lastrowid for cursor in cursors]
+            return [cursor.rowcount for cursor in cursors]
+        except Exception:
+            conn.rollback()
+            raise
+    
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking callable on the database thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    async def execute(self, sql: str, params=(), fetch: Optional[str] = None, many: bool = False):
+        """Awaitable wrapper around _query"""
+        with metrics.track('sqlite_seconds', 'sqlite_in_flight', op=sql.split(None, 1)[0].upper()):
+            return await self._run(self._query, sql, params, fetch=fetch, many=many)
+    
+    async def execute_each(self, sql: str, params_list, fetch: Optional[str] = None) -> List[int]:
+        """Awaitable wrapper around _query_each"""
+        with metrics.track('sqlite_seconds', 'sqlite_in_flight', op=sql.split(None, 1)[0].upper()):
+            return await self._run(self._query_each, sql, params_list, fetch=fetch)
+    
+    async def close(self):
+        """Close the connection and stop the worker thread"""
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        
+        await self._run(_close)
+        self._executor.shutdown(wait=True)
+        logger.info("Database closed")
+    
+    async def add_token(self, token: str, userid: str) -> Optional[int]:
+        """Add a new token and userid to the database, returning its ID"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute(
+            token_id = await self.execute(
                 'INSERT INTO tokens (token, userid) VALUES (?, ?)',
-                (token, userid)
+                (token, userid),
+                fetch='lastrowid'
             )
-            conn.commit()
-            conn.close()
             logger.info(f"Added token for userid: {userid}")
-            return True
+            return token_id
         except Exception as e:
             logger.error(f"Error adding token: {e}")
-            return False
+            return None
+    
+    async def add_tokens(self, tokens: List[Tuple[str, str]]) -> List[int]:
+        """Add many (token, userid) pairs in one transaction, returning their IDs in order"""
+        if not tokens:
+            return []
+        token_ids = await self.execute_each(
+            'INSERT INTO tokens (token, userid) VALUES (?, ?)', tokens, fetch='lastrowid'
+        )
+        logger.info(f"Added {len(token_ids)} token(s)")
+        return token_ids
     
-    def get_first_token(self) -> Optional[Tuple[int, str, str]]:
+    async def get_first_token(self) -> Optional[Tuple[int, str, str]]:
         """Get the first (oldest) token from the database"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, token, userid FROM tokens ORDER BY id ASC LIMIT 1'
+        return await self.execute(
+            'SELECT id, token, userid FROM tokens ORDER BY id ASC LIMIT 1',
+            fetch='one'
         )
-        result = cursor.fetchone()
-        conn.close()
-        return result
     
-    def get_all_tokens(self) -> List[Tuple]:
+    async def get_all_tokens(self) -> List[Tuple]:
         """Get all tokens with their details"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, token, userid, remaining_traffic, last_checked FROM tokens ORDER BY id ASC'
+        return await self.execute(
+            'SELECT id, token, userid, remaining_traffic, last_checked FROM tokens ORDER BY id ASC',
+            fetch='all'
         )
-        results = cursor.fetchall()
-        conn.close()
-        return results
     
-    def update_balance(self, token_id: int, remaining_traffic: int):
-        """Update the remaining traffic for a token"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE tokens SET remaining_traffic = ?, last_checked = ? WHERE id = ?',
-            (remaining_traffic, datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"), token_id)
+    @staticmethod
+    def _filter_clause(token_filter: str) -> Tuple[str, Tuple]:
+        """SQL condition and parameters for a /showall filter"""
+        if token_filter == 'low':
+            return 'last_checked IS NOT NULL AND remaining_traffic <= ?', (SHOWALL_LOW_BALANCE,)
+        if token_filter == 'stale':
+            cutoff = datetime.fromtimestamp(time.time() - SHOWALL_STALE_SECONDS).strftime("%Y-%m-%d %H:%M:%S.%f")
+            return '(last_checked IS NULL OR last_checked < ?)', (cutoff,)
+        return '1', ()
+    
+    async def get_tokens_page(self, cursor: int = 0, forward: bool = True, limit: int = SHOWALL_PAGE_SIZE,
+                              token_filter: str = 'all') -> Tuple[List[Tuple], bool, bool]:
+        """Fetch one page of tokens by keyset on id
+        
+        Going forward returns the tokens after `cursor`, going back the tokens
+        before it, always in ascending id order. Returns (rows, has_previous,
+        has_next); every query is an index range scan, so the cost does not grow
+        with the size of the table.
+        """
+        clause, params = self._filter_clause(token_filter)
+        columns = 'id, token, userid, remaining_traffic, last_checked'
+        if forward:
+            rows = await self.execute(
+                f'SELECT {columns} FROM tokens WHERE id > ? AND {clause} ORDER BY id ASC LIMIT ?',
+                (cursor, *params, limit + 1), fetch='all'
+            )
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            rows = await self.execute(
+                f'SELECT {columns} FROM tokens WHERE id < ? AND {clause} ORDER BY id DESC LIMIT ?',
+                (cursor, *params, limit + 1), fetch='all'
+            )
+            has_more = len(rows) > limit
+            rows = rows[:limit][::-1]
+        
+        if not rows:
+            return rows, False, False
+        
+        # The far side of the page needs one more existence probe
+        if forward:
+            probe = await self.execute(
+                f'SELECT 1 FROM tokens WHERE id < ? AND {clause} LIMIT 1', (rows[0][0], *params), fetch='one'
+            )
+            return rows, probe is not None, has_more
+        probe = await self.execute(
+            f'SELECT 1 FROM tokens WHERE id > ? AND {clause} LIMIT 1', (rows[-1][0], *params), fetch='one'
         )
-        conn.commit()
-        conn.close()
+        return rows, has_more, probe is not None
     
-    def delete_token(self, token_id: int) -> bool:
-        """Delete a token by ID"""
+    def _write_batch(self, updates: List[Tuple[int, int, str]], token_ids: List[int],
+                     samples: List[Tuple[int, str, int, int]] = ()) -> Tuple[int, int]:
+        """Apply balance readings, history samples, then low-balance deletions, in one transaction (worker thread only)"""
+        conn = self._connection()
+        try:
+            if samples:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO balance_history (token_id, checked_at, remaining_traffic, consumed) '
+                    'VALUES (?, ?, ?, ?)',
+                    samples
+                )
+            updated = conn.executemany(
+                'UPDATE tokens SET remaining_traffic = ?, last_checked = ? '
+                'WHERE id = ? AND (last_checked IS NULL OR last_checked <= ?)',
+                [(remaining_traffic, checked_at, token_id, checked_at) for token_id, remaining_traffic, checked_at in updates]
+            ).rowcount if updates else 0
+            now = time.time()
+            deleted = conn.executemany(
+                'DELETE FROM tokens WHERE id = ? AND remaining_traffic < ? '
+                'AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires < ?)',
+                [(token_id, LOW_BALANCE_THRESHOLD, INSTANCE_ID, now) for token_id in token_ids]
+            ).rowcount if token_ids else 0
+            conn.commit()
+            return updated, deleted
+        except Exception:
+            conn.rollback()
+            raise
+    
+    async def write_batch(self, updates: List[Tuple[int, int, str]], token_ids: List[int],
+                          samples: List[Tuple[int, str, int, int]] = ()) -> Tuple[int, int]:
+        """Store (token_id, remaining_traffic, checked_at) readings and delete low-balance tokens in one transaction
+        
+        `samples` are (token_id, checked_at, remaining_traffic, consumed) rows
+        appended to the balance history in the same transaction.
+        
+        Balance writes are a compare-and-set on last_checked, so a reading older
+        than the stored one (e.g. written meanwhile by another instance) is
+        dropped. A token is only deleted if its stored balance is still below
+        the threshold and no other live instance holds its lease, so concurrent
+        sweeps never delete twice or delete a token still in use. Returns the
+        number of rows updated and deleted.
+        """
+        if not updates and not token_ids and not samples:
+            return 0, 0
+        with metrics.track('sqlite_seconds', 'sqlite_in_flight', op='BATCH'):
+            return await self._run(self._write_batch, updates, token_ids, samples)
+    
+    def _rollup_history(self, now: datetime) -> Tuple[int, int]:
+        """Roll raw readings into hourly and daily buckets and drop expired data (worker thread only)
+        
+        Only complete hours are rolled up. The last rolled-up hour is redone
+        each run so late readings are folded in; INSERT OR REPLACE keeps reruns
+        idempotent. Returns the number of hourly buckets written and raw rows
+        removed.
+        """
+        conn = self._connection()
+        fmt = "%Y-%m-%d %H:%M:%S"
+        current_hour = now.replace(minute=0, second=0, microsecond=0).strftime(fmt)
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM tokens WHERE id = ?', (token_id,))
+            row = conn.execute(
+                "SELECT MAX(bucket_start) FROM balance_rollups WHERE granularity = 'hour'"
+            ).fetchone()
+            start = row[0] or conn.execute('SELECT MIN(checked_at) FROM balance_history').fetchone()[0]
+            if start is None:
+                return 0, 0
+            start = start[:13] + ':00:00'
+            
+            hours = conn.execute(
+                '''
+                INSERT OR REPLACE INTO balance_rollups
+                    (granularity, token_id, bucket_start, samples, consumed, last_traffic, last_checked)
+                SELECT 'hour', token_id, substr(checked_at, 1, 13) || ':00:00',
+                       COUNT(*), SUM(consumed), remaining_traffic, MAX(checked_at)
+                FROM balance_history
+                WHERE checked_at >= ? AND checked_at < ?
+                GROUP BY token_id, substr(checked_at, 1, 13)
+                ''',
+                (start, current_hour)
+            ).rowcount
+            
+            conn.execute(
+                '''
+                INSERT OR REPLACE INTO balance_rollups
+                    (granularity, token_id, bucket_start, samples, consumed, last_traffic, last_checked)
+                SELECT 'day', token_id, substr(bucket_start, 1, 10) || ' 00:00:00',
+                       SUM(samples), SUM(consumed), last_traffic, MAX(last_checked)
+                FROM balance_rollups
+                WHERE granularity = 'hour' AND bucket_start >= ?
+                GROUP BY token_id, substr(bucket_start, 1, 10)
+                ''',
+                (start[:10] + ' 00:00:00',)
+            )
+            
+            raw_cutoff = min(current_hour, (now - timedelta(days=HISTORY_RAW_RETENTION_DAYS)).strftime(fmt))
+            removed = conn.execute('DELETE FROM balance_history WHERE checked_at < ?', (raw_cutoff,)).rowcount
+            conn.execute(
+                "DELETE FROM balance_rollups WHERE granularity = 'hour' AND bucket_start < ?",
+                ((now - timedelta(days=HISTORY_HOURLY_RETENTION_DAYS)).strftime(fmt),)
+            )
             conn.commit()
-            conn.close()
+            return hours, removed
+        except Exception:
+            conn.rollback()
+            raise
+    
+    async def rollup_history(self) -> Tuple[int, int]:
+        """Awaitable wrapper around _rollup_history"""
+        with metrics.track('sqlite_seconds', 'sqlite_in_flight', op='ROLLUP'):
+            return await self._run(self._rollup_history, datetime.now())
+    
+    async def get_consumption(self, granularity: str, since: str, token_id: Optional[int] = None) -> List[Tuple[str, int, int]]:
+        """(bucket_start, consumed, samples) per bucket since `since`, for one token or the whole fleet"""
+        if token_id is not None:
+            return await self.execute(
+                'SELECT bucket_start, consumed, samples FROM balance_rollups '
+                'WHERE granularity = ? AND token_id = ? AND bucket_start >= ? ORDER BY bucket_start',
+                (granularity, token_id, since), fetch='all'
+            )
+        return await self.execute(
+            'SELECT bucket_start, SUM(consumed), SUM(samples) FROM balance_rollups '
+            'WHERE granularity = ? AND bucket_start >= ? GROUP BY bucket_start ORDER BY bucket_start',
+            (granularity, since), fetch='all'
+        )
+    
+    async def get_top_consumers(self, since: str, limit: int = 5) -> List[Tuple[int, int]]:
+        """(token_id, consumed) of the heaviest tokens since `since`, from daily rollups"""
+        return await self.execute(
+            "SELECT token_id, SUM(consumed) AS total FROM balance_rollups "
+            "WHERE granularity = 'day' AND bucket_start >= ? GROUP BY token_id ORDER BY total DESC LIMIT ?",
+            (since, limit), fetch='all'
+        )
+    
+    async def add_orders(self, orders: List[Tuple]) -> int:
+        """Append ledger rows (created_at, user_id, username, country_code, requested, delivered, outcome, tokens, duration_ms)"""
+        if not orders:
+            return 0
+        return await self.execute(
+            'INSERT INTO orders (created_at, user_id, username, country_code, requested, delivered, '
+            'outcome, tokens, duration_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            orders,
+            many=True
+        )
+    
+    async def get_orders_page(self, after_id: int, since: str, limit: int = ORDER_EXPORT_CHUNK) -> List[Tuple]:
+        """Ledger rows created since `since` with id greater than `after_id`, by keyset on id"""
+        return await self.execute(
+            'SELECT id, created_at, user_id, username, country_code, requested, delivered, outcome, tokens, duration_ms '
+            'FROM orders WHERE id > ? AND created_at >= ? ORDER BY id ASC LIMIT ?',
+            (after_id, since, limit), fetch='all'
+        )
+    
+    async def get_order_totals(self, since: str, limit: int = 10) -> List[Tuple[str, int, int]]:
+        """(country_code, orders, proxies delivered) since `since`, busiest countries first"""
+        return await self.execute(
+            'SELECT country_code, COUNT(*), SUM(delivered) AS proxies FROM orders '
+            'WHERE created_at >= ? GROUP BY country_code ORDER BY proxies DESC LIMIT ?',
+            (since, limit), fetch='all'
+        )
+    
+    async def delete_token(self, token_id: int) -> bool:
+        """Delete a token by ID"""
+        try:
+            await self.execute('DELETE FROM tokens WHERE id = ?', (token_id,))
             logger.info(f"Deleted token ID: {token_id}")
             return True
         except Exception as e:
             logger.error(f"Error deleting token: {e}")
             return False
     
-    def delete_first_token(self) -> bool:
+    async def claim_token(self, token_id: int, owner: str = INSTANCE_ID, ttl: float = TOKEN_LEASE_SECONDS) -> bool:
+        """Lease a token to `owner` unless another owner holds an unexpired lease"""
+        now = time.time()
+        rowcount = await self.execute(
+            'UPDATE tokens SET lease_owner = ?, lease_expires = ? '
+            'WHERE id = ? AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires < ?)',
+            (owner, now + ttl, token_id, owner, now)
+        )
+        return rowcount == 1
+    
+    async def release_token(self, token_id: int, owner: str = INSTANCE_ID):
+        """Give up a lease held by `owner`"""
+        await self.execute(
+            'UPDATE tokens SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?',
+            (token_id, owner)
+        )
+    
+    async def release_all_tokens(self, owner: str = INSTANCE_ID):
+        """Give up every lease held by `owner`"""
+        await self.execute(
+            'UPDATE tokens SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?',
+            (owner,)
+        )
+    
+    async def acquire_lock(self, name: str, owner: str = INSTANCE_ID, ttl: float = SWEEP_LOCK_SECONDS) -> bool:
+        """Take or renew a named lock; fails while another owner holds it unexpired"""
+        now = time.time()
+        await self.execute('INSERT OR IGNORE INTO locks (name, owner, expires) VALUES (?, ?, 0)', (name, owner))
+        rowcount = await self.execute(
+            'UPDATE locks SET owner = ?, expires = ? WHERE name = ? AND (owner = ? OR expires < ?)',
+            (owner, now + ttl, name, owner, now)
+        )
+        return rowcount == 1
+    
+    async def release_lock(self, name: str, owner: str = INSTANCE_ID):
+        """Release a named lock if `owner` still holds it"""
+        await self.execute('UPDATE locks SET expires = 0 WHERE name = ? AND owner = ?', (name, owner))
+    
+    async def delete_first_token(self) -> bool:
         """Delete the first token"""
-        first_token = self.get_first_token()
+        first_token = await self.get_first_token()
         if first_token:
-            return self.delete_token(first_token[0])
+            return await self.delete_token(first_token[0])
         return False
     
-    def delete_all_tokens(self) -> bool:
+    async def delete_all_tokens(self) -> bool:
         """Delete all tokens from the database"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM tokens')
-            conn.commit()
-            conn.close()
+            await self.execute('DELETE FROM tokens')
             logger.info("All tokens deleted")
             return True
         except Exception as e:
             logger.error(f"Error deleting all tokens: {e}")
             return False
     
-    def count_tokens(self) -> int:
+    async def count_tokens(self) -> int:
         """Count total tokens in database"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM tokens')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        row = await self.execute('SELECT COUNT(*) FROM tokens', fetch='one')
+        return row[0]
+
+
+class TransientAPIError(Exception):
+    """Upstream answered with a status worth retrying (429 or 5xx)"""
+    
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class RequestRejected(Exception):
+    """Upstream answered a call with an error that may concern the request rather than the token
+    
+    A drained token and a country with no inventory look alike, so the call is
+    not counted against the token until the caller knows which it was.
+    """
+    
+    def __init__(self, message: str, latency: float):
+        super().__init__(message)
+        self.latency = latency
+
+
+class CircuitBreaker:
+    """Fail fast after repeated failures
+    
+    The breaker opens after BREAKER_FAILURE_THRESHOLD consecutive failures.
+    Once BREAKER_RESET_TIMEOUT seconds have passed it lets calls through again
+    (half-open): the next success closes it, the next failure re-opens it.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+    
+    def allow(self) -> bool:
+        """True unless the breaker is open"""
+        return self.state != 'open'
+    
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class TokenHealth:
+    """Call statistics and quarantine state for one token"""
+    
+    __slots__ = ('outcomes', 'latency', 'last_error', 'quarantined_until', 'quarantine_count')
+    
+    def __init__(self):
+        self.outcomes = deque(maxlen=HEALTH_WINDOW)
+        self.latency: Optional[float] = None  # Smoothed seconds per call
+        self.last_error: Optional[str] = None
+        self.quarantined_until: Optional[float] = None  # time.monotonic(); set until a re-probe succeeds
+        self.quarantine_count = 0
+    
+    @property
+    def success_rate(self) -> Optional[float]:
+        if not self.outcomes:
+            return None
+        return sum(self.outcomes) / len(self.outcomes)
+
+
+class HealthTracker:
+    """Per-token health scoring with timed quarantine
+    
+    A token is quarantined once it has HEALTH_MIN_SAMPLES recent calls and its
+    success rate drops below HEALTH_MIN_SUCCESS_RATE or its smoothed latency
+    exceeds HEALTH_MAX_LATENCY. When the quarantine expires the token needs a
+    successful re-probe before it is used again; a failed probe doubles the
+    quarantine, up to QUARANTINE_MAX.
+    """
+    
+    def __init__(self):
+        self._stats: Dict[str, TokenHealth] = {}
+    
+    def get(self, token: str) -> TokenHealth:
+        if token not in self._stats:
+            self._stats[token] = TokenHealth()
+        return self._stats[token]
+    
+    def record(self, token: str, ok: bool, latency: float, error: Optional[str] = None):
+        """Record the outcome of one API call made with a token"""
+        health = self.get(token)
+        health.outcomes.append(ok)
+        health.latency = latency if health.latency is None else 0.7 * health.latency + 0.3 * latency
+        if error:
+            health.last_error = error
+        
+        now = time.monotonic()
+        if health.quarantined_until is not None:
+            if ok:
+                health.quarantined_until = None
+                health.quarantine_count = 0
+                health.outcomes.clear()
+                logger.info(f"Token {token[:8]} passed its re-probe and left quarantine")
+            elif now >= health.quarantined_until:
+                self._quarantine(token, health, now)
+            return
+        
+        if len(health.outcomes) >= HEALTH_MIN_SAMPLES and (
+            health.success_rate < HEALTH_MIN_SUCCESS_RATE or health.latency > HEALTH_MAX_LATENCY
+        ):
+            self._quarantine(token, health, now)
+    
+    def _quarantine(self, token: str, health: TokenHealth, now: float):
+        duration = min(QUARANTINE_MAX, QUARANTINE_BASE * 2 ** health.quarantine_count)
+        health.quarantine_count += 1
+        health.quarantined_until = now + duration
+        logger.warning(
+            f"Token {token[:8]} quarantined for {duration}s "
+            f"(success rate {health.success_rate:.0%}, latency {health.latency:.1f}s, last error: {health.last_error})"
+        )
+    
+    def is_available(self, token: str) -> bool:
+        """False while the token is quarantined or waiting for a re-probe"""
+        health = self._stats.get(token)
+        return health is None or health.quarantined_until is None
+    
+    def is_quarantined(self, token: str) -> bool:
+        """True while the token's quarantine is still running"""
+        health = self._stats.get(token)
+        return health is not None and health.quarantined_until is not None and time.monotonic() < health.quarantined_until
+    
+    def needs_probe(self, token: str) -> bool:
+        """True once a quarantine has expired and the token should be re-probed"""
+        health = self._stats.get(token)
+        return health is not None and health.quarantined_until is not None and time.monotonic() >= health.quarantined_until
+
+
+token_health = HealthTracker()
 
 
 class ProxyAPI:
-    """Handle all API operations asynchronously"""
+    """Handle all API operations asynchronously over a shared connection pool"""
+    
+    _client: Optional[httpx.AsyncClient] = None
+    _endpoint_breakers: Dict[str, CircuitBreaker] = {}
+    _token_breakers: Dict[str, CircuitBreaker] = {}
+    
+    @classmethod
+    async def startup(cls):
+        """Open the shared HTTP client (called once when the bot starts)"""
+        cls.get_client()
+    
+    @classmethod
+    async def shutdown(cls):
+        """Close the shared HTTP client and its pooled connections"""
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+            logger.info("HTTP client closed")
+    
+    @classmethod
+    def get_client(cls) -> httpx.AsyncClient:
+        """Return the shared client, creating it on first use"""
+        if cls._client is None:
+            http2 = HTTP2_ENABLED and HTTP2_AVAILABLE
+            cls._client = httpx.AsyncClient(
+                headers=DEFAULT_HEADERS,
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(BALANCE_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+            )
+            logger.info(f"HTTP client started (HTTP/2: {'on' if http2 else 'off'})")
+        return cls._client
     
     @staticmethod
-    async def check_balance(token: str, userid: str) -> Optional[Dict]:
-        """Check the remaining traffic balance"""
-        headers = DEFAULT_HEADERS.copy()
-        headers['Token'] = token
-        headers['Userid'] = userid
+    def _auth_headers(token: str, userid: str) -> Dict[str, str]:
+        """Per-account headers sent on top of the client defaults"""
+        return {'Token': token, 'Userid': userid}
+    
+    @classmethod
+    def _breaker(cls, breakers: Dict[str, 'CircuitBreaker'], key: str, name: str) -> 'CircuitBreaker':
+        if key not in breakers:
+            breakers[key] = CircuitBreaker(name)
+        return breakers[key]
+    
+    @classmethod
+    def is_token_blocked(cls, token: str) -> bool:
+        """True while the token's circuit breaker is open"""
+        breaker = cls._token_breakers.get(token)
+        return breaker is not None and not breaker.allow()
+    
+    @classmethod
+    def record_token_outcome(cls, token: str, ok: bool, latency: float, error: Optional[str] = None):
+        """Count a call whose outcome _request left open on the token's breaker and health"""
+        token_breaker = cls._breaker(cls._token_breakers, token, f"token {token[:8]}")
+        if ok:
+            token_breaker.record_success()
+        else:
+            token_breaker.record_failure()
+        token_health.record(token, ok, latency, error)
+    
+    @classmethod
+    async def _request(cls, method: str, url: str, token: str, userid: str, timeout: float,
+                       action: str, idempotent: bool = True, raise_rejections: bool = False,
+                       **kwargs) -> Optional[Any]:
+        """Send one API call with retries and circuit breaking, returning `data` on success
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            try:
-                response = await client.get(BALANCE_ENDPOINT, headers=headers)
-                response.raise_for_status()
-                data = response.json()
+        Transient failures (network errors, HTTP 429 and 5xx) are retried with
+        jittered exponential backoff. Non-idempotent calls are only retried when
+        the request cannot have reached the server. Failures are counted on a
+        per-endpoint and a per-token breaker; while either is open the call fails
+        fast and returns None. With raise_rejections, a non-200 answer that is not
+        an auth error raises RequestRejected instead, leaving the token's breaker
+        and health to the caller (see record_token_outcome).
+        """
+        endpoint = url.rsplit('/', 1)[-1]
+        endpoint_breaker = cls._breaker(cls._endpoint_breakers, url, endpoint)
+        token_breaker = cls._breaker(cls._token_breakers, token, f"token {token[:8]}")
+        
+        if not endpoint_breaker.allow() or not token_breaker.allow():
+            logger.warning(f"Skipping {action}: circuit open")
+            metrics.inc('upstream_requests_total', endpoint=endpoint, outcome='circuit_open')
+            return None
+        
+        headers = cls._auth_headers(token, userid)
+        request_timeout = httpx.Timeout(timeout, connect=API_CONNECT_TIMEOUT)
+        started = time.monotonic()
+        
+        with metrics.track('upstream_request_seconds', 'upstream_in_flight', endpoint=endpoint):
+            for attempt in range(API_MAX_RETRIES + 1):
+                try:
+                    response = await cls.get_client().request(
+                        method, url, headers=headers, timeout=request_timeout, **kwargs
+                    )
+                    if response.status_code == 429 or response.status_code >= 500:
+                        raise TransientAPIError(f"HTTP {response.status_code}", retryable=idempotent or response.status_code == 429)
+                    response.raise_for_status()
+                    data = response.json()
+                except (httpx.TransportError, TransientAPIError) as e:
+                    retryable = (
+                        e.retryable if isinstance(e, TransientAPIError)
+                        else idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+                    )
+                    if retryable and attempt < API_MAX_RETRIES:
+                        delay = random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+                        logger.warning(f"Transient error during {action} ({e!r}), retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        continue
+                    endpoint_breaker.record_failure()
+                    token_breaker.record_failure()
+                    token_health.record(token, False, time.monotonic() - started, f"{action}: {e!r}")
+                    logger.error(f"Error during {action}: {e!r}")
+                    metrics.inc('upstream_requests_total', endpoint=endpoint, outcome='error')
+                    return None
+                except Exception as e:
+                    # The endpoint answered, so only the token is blamed
+                    endpoint_breaker.record_success()
+                    token_breaker.record_failure()
+                    token_health.record(token, False, time.monotonic() - started, f"{action}: {e}")
+                    logger.error(f"Error during {action}: {e}")
+                    metrics.inc('upstream_requests_total', endpoint=endpoint, outcome='error')
+                    return None
                 
+                endpoint_breaker.record_success()
                 if data.get('code') == 200:
+                    token_breaker.record_success()
+                    token_health.record(token, True, time.monotonic() - started)
+                    metrics.inc('upstream_requests_total', endpoint=endpoint, outcome='success')
                     return data.get('data')
-                else:
-                    logger.error(f"Balance check failed: {data.get('msg')}")
-                    return None
-            except Exception as e:
-                logger.error(f"Error checking balance: {e}")
+                if raise_rejections and data.get('code') not in API_AUTH_ERROR_CODES:
+                    logger.warning(f"{action.capitalize()} rejected: {data.get('msg')}")
+                    metrics.inc('upstream_requests_total', endpoint=endpoint, outcome='rejected')
+                    raise RequestRejected(data.get('msg') or f"code {data.get('code')}", time.monotonic() - started)
+                token_breaker.record_failure()
+                token_health.record(token, False, time.monotonic() - started, f"{action}: {data.get('msg')}")
+                logger.error(f"{action.capitalize()} failed: {data.get('msg')}")
+                metrics.inc('upstream_requests_total', endpoint=endpoint, outcome='rejected')
                 return None
     
-    @staticmethod
-    async def create_proxy(token: str, userid: str, country_code: str, good_num: int = 1) -> Optional[List[Dict]]:
-        """Create proxy with specified parameters"""
-        headers = DEFAULT_HEADERS.copy()
-        headers['Token'] = token
-        headers['Userid'] = userid
-        headers['Content-Type'] = 'application/json'
+    @classmethod
+    async def check_balance(cls, token: str, userid: str) -> Optional[Dict]:
+        """Check the remaining traffic balance"""
+        return await cls._request(
+            'GET', BALANCE_ENDPOINT, token, userid, BALANCE_TIMEOUT, action='balance check'
+        )
+    
+    @classmethod
+    async def create_proxy(cls, token: str, userid: str, country_code: str, good_num: int = 1) -> Optional[List[Dict]]:
+        """Create proxy with specified parameters
         
+        Raises RequestRejected when the API refuses the order.
+        """
         payload = {
             "proxyType": "socks5",
             "proxyHost": "change4.owlproxy.com:7778",
             "countryCode": country_code.upper(),
             "state": "",
             "city": "",
-            "time": 5,
+            "time": PROXY_SESSION_MINUTES,
             "goodNum": good_num,
             "format": "protocol://ip:port:user:pass"
         }
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            try:
-                response = await client.post(CREATE_PROXY_ENDPOINT, headers=headers, json=payload)
-                response.raise_for_status()
-                data = response.json()
-                
-                if data.get('code') == 200:
-                    return data.get('data')
-                else:
-                    logger.error(f"Proxy creation failed: {data.get('msg')}")
-                    return None
-            except Exception as e:
-                logger.error(f"Error creating proxy: {e}")
-                return None
+        # Creating proxies is not idempotent: a retried call could be billed twice
+        return await cls._request(
+            'POST', CREATE_PROXY_ENDPOINT, token, userid, CREATE_PROXY_TIMEOUT,
+            action='proxy creation', idempotent=False, raise_rejections=True, json=payload
+        )
     
     @staticmethod
     def format_proxy(proxy_data: Dict) -> str:
@@ -446,8 +1457,379 @@ class ProxyAPI:
         return f"{proxy_data['proxyHost']}:{proxy_data['proxyPort']}:{proxy_data['userName']}:{proxy_data['password']}"
 
 
-# Initialize database
+class TokenRecord:
+    """In-memory copy of one row of the tokens table"""
+    
+    __slots__ = ('id', 'token', 'userid', 'remaining_traffic', 'last_checked', 'in_flight',
+                 'estimated_traffic', 'reconciled_at', 'reconciling', 'burn_rate', 'next_check_at',
+                 'lease_claimed_at')
+    
+    def __init__(self, token_id: int, token: str, userid: str,
+                 remaining_traffic: Optional[int] = 0, last_checked: Optional[str] = None):
+        self.id = token_id
+        self.token = token
+        self.userid = userid
+        self.remaining_traffic = remaining_traffic
+        self.last_checked = last_checked
+        self.in_flight = 0  # Proxy creation calls currently using this token
+        self.estimated_traffic = float(remaining_traffic or 0)  # Local estimate between API readings
+        self.reconciled_at: Optional[float] = None  # time.monotonic() of the last API reading
+        self.reconciling = False
+        self.burn_rate = 0.0  # Smoothed MB/s drawn from successive balance readings
+        self.next_check_at: Optional[float] = None  # time.monotonic() when the poller should check next; None = now
+        self.lease_claimed_at: Optional[float] = None  # time.monotonic() of the last successful lease claim
+    
+    def is_usable(self) -> bool:
+        """True unless the token is quarantined, its circuit is open or its balance is below the threshold"""
+        if not token_health.is_available(self.token) or ProxyAPI.is_token_blocked(self.token):
+            return False
+        return self.last_checked is None or (self.remaining_traffic or 0) >= LOW_BALANCE_THRESHOLD
+    
+    def record_usage(self, proxies: int):
+        """Debit the local balance estimate for newly generated proxies"""
+        self.estimated_traffic -= proxies * ESTIMATED_MB_PER_PROXY
+    
+    def needs_reconcile(self) -> bool:
+        """True when the estimate is too old or too close to the threshold to trust"""
+        if self.reconciled_at is None:
+            return True
+        if self.estimated_traffic < LOW_BALANCE_THRESHOLD + RECONCILE_MARGIN:
+            return True
+        return time.monotonic() - self.reconciled_at >= RECONCILE_INTERVAL
+    
+    def apply_reading(self, remaining_traffic: int, now: float):
+        """Fold a new API balance reading into the burn rate and reschedule polling"""
+        if self.reconciled_at is not None and now > self.reconciled_at:
+            used = max(0, (self.remaining_traffic or 0) - remaining_traffic)
+            rate = used / (now - self.reconciled_at)
+            self.burn_rate += BURN_RATE_SMOOTHING * (rate - self.burn_rate)
+        
+        self.remaining_traffic = remaining_traffic
+        self.estimated_traffic = float(remaining_traffic)
+        self.reconciled_at = now
+        
+        headroom = remaining_traffic - LOW_BALANCE_THRESHOLD
+        if self.burn_rate > 0:
+            interval = headroom / self.burn_rate * POLL_HEADROOM_FRACTION
+        else:
+            interval = POLL_MAX_INTERVAL
+        self.schedule_check(now, min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, interval)))
+    
+    def schedule_check(self, now: float, interval: float):
+        """Set the next poll time, with jitter"""
+        self.next_check_at = now + interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+    
+    def is_due(self, now: float) -> bool:
+        """True when the adaptive poller should check this token"""
+        return self.next_check_at is None or self.next_check_at <= now
+    
+    def as_row(self) -> Tuple:
+        """Return the record in the same shape as Database.get_all_tokens rows"""
+        return self.id, self.token, self.userid, self.remaining_traffic, self.last_checked
+
+
+class TokenRegistry:
+    """In-process token cache backed by the tokens table
+    
+    The whole tokens table is loaded once at startup and every read is served
+    from memory. Adding and explicitly deleting tokens is write-through: the
+    database is written first and the cache only once that succeeded.
+    
+    Balance readings and low-balance removals are write-behind: they take
+    effect in the cache at once and are buffered until flush(), which writes
+    them all in one transaction. Flushes happen every WRITE_BEHIND_INTERVAL
+    seconds, at the end of each sweep, once WRITE_BEHIND_MAX_PENDING changes
+    are waiting, and at shutdown.
+    
+    Other instances sharing the database are picked up by refresh(). A token is
+    leased in the database while this instance has calls in flight on it, so
+    no two instances use the same token at once.
+    """
+    
+    def __init__(self, database: Database):
+        self.db = database
+        self._tokens: Dict[int, TokenRecord] = {}
+        self._next_index = 0  # Round-robin cursor
+        self._pending_balances: Dict[int, Tuple[int, str, int]] = {}  # token_id -> (remaining_traffic, checked_at, consumed)
+        self._pending_deletes = set()
+        self._deleting = set()  # Removals handed to a flush that has not finished yet
+        self._flush_lock = asyncio.Lock()
+    
+    async def load(self):
+        """(Re)load every token from the database"""
+        rows = await self.db.get_all_tokens()
+        self._tokens = {row[0]: TokenRecord(*row) for row in rows}
+        logger.info(f"Loaded {len(self._tokens)} token(s) into the registry")
+    
+    async def refresh(self):
+        """Merge in tokens added, removed or re-checked by other instances
+        
+        In-memory state (in-flight calls, burn rate, poll schedule) of tokens
+        that are still present is kept.
+        """
+        rows = await self.db.get_all_tokens()
+        tokens: Dict[int, TokenRecord] = {}
+        for token_id, token, userid, remaining_traffic, last_checked in rows:
+            if token_id in self._pending_deletes or token_id in self._deleting:
+                continue
+            record = self._tokens.get(token_id)
+            if record is None:
+                record = TokenRecord(token_id, token, userid, remaining_traffic, last_checked)
+            elif last_checked and (record.last_checked is None or last_checked > record.last_checked):
+                record.remaining_traffic = remaining_traffic
+                record.estimated_traffic = float(remaining_traffic or 0)
+                record.last_checked = last_checked
+            tokens[token_id] = record
+        
+        added = len(tokens.keys() - self._tokens.keys())
+        removed = len(self._tokens.keys() - tokens.keys())
+        self._tokens = tokens
+        if added or removed:
+            logger.info(f"Registry refresh: {added} token(s) added, {removed} removed by other instances")
+    
+    def __len__(self) -> int:
+        return len(self._tokens)
+    
+    def get(self, token_id: int) -> Optional[TokenRecord]:
+        """Look up a token by ID"""
+        return self._tokens.get(token_id)
+    
+    def first(self) -> Optional[TokenRecord]:
+        """Return the first (oldest) token"""
+        return next(iter(self._tokens.values()), None)
+    
+    def all(self) -> List[TokenRecord]:
+        """Return every token, oldest first"""
+        return list(self._tokens.values())
+    
+    def due_for_check(self) -> List[TokenRecord]:
+        """Tokens whose adaptive poll time has come, plus quarantined tokens due for a re-probe"""
+        now = time.monotonic()
+        return [
+            r for r in self._tokens.values()
+            if token_health.needs_probe(r.token) or (r.is_due(now) and not token_health.is_quarantined(r.token))
+        ]
+    
+    async def acquire(self, exclude=(), policy: Optional[str] = None) -> Optional[TokenRecord]:
+        """Pick a usable token according to the selection policy and mark it in flight
+        
+        Tokens whose IDs are in `exclude` are skipped, as are tokens leased by
+        another instance. The first call on a token claims its lease, and a
+        later call renews it once half of TOKEN_LEASE_SECONDS has passed. Every
+        successful acquire must be paired with a release().
+        """
+        candidates = [r for r in self._tokens.values() if r.id not in exclude and r.is_usable()]
+        if not candidates:
+            return None
+        
+        policy = policy or TOKEN_SELECTION_POLICY
+        if policy == 'balance':
+            candidates.sort(key=lambda r: (-(r.remaining_traffic or 0), r.in_flight))
+        elif policy == 'least_inflight':
+            candidates.sort(key=lambda r: (r.in_flight, r.id))
+        else:
+            start = self._next_index % len(candidates)
+            candidates = candidates[start:] + candidates[:start]
+            self._next_index += 1
+        
+        for record in candidates:
+            # Reserve locally before awaiting the claim so concurrent acquires
+            # in this process don't claim the same lease twice
+            record.in_flight += 1
+            claimed_at = record.lease_claimed_at
+            if (record.in_flight > 1 and claimed_at is not None
+                    and time.monotonic() - claimed_at < TOKEN_LEASE_SECONDS / 2):
+                return record
+            now = time.monotonic()
+            if await self.db.claim_token(record.id):
+                record.lease_claimed_at = now
+                return record
+            record.in_flight -= 1
+            metrics.inc('token_lease_conflicts_total')
+        return None
+    
+    async def release(self, record: TokenRecord):
+        """Mark one call on an acquired token as finished, dropping the lease after the last one"""
+        record.in_flight = max(0, record.in_flight - 1)
+        if record.in_flight == 0:
+            record.lease_claimed_at = None
+            try:
+                await self.db.release_token(record.id)
+            except Exception as e:
+                # The lease expires on its own after TOKEN_LEASE_SECONDS
+                logger.warning(f"Error releasing lease on token ID {record.id}: {e}")
+    
+    async def add(self, token: str, userid: str) -> Optional[TokenRecord]:
+        """Persist a new token and add it to the cache"""
+        token_id = await self.db.add_token(token, userid)
+        if token_id is None:
+            return None
+        record = TokenRecord(token_id, token, userid)
+        self._tokens[token_id] = record
+        return record
+    
+    async def add_many(self, tokens: List[Tuple[str, str]]) -> List[TokenRecord]:
+        """Persist many (token, userid) pairs in one transaction and add them to the cache"""
+        token_ids = await self.db.add_tokens(tokens)
+        records = [TokenRecord(token_id, token, userid) for token_id, (token, userid) in zip(token_ids, tokens)]
+        for record in records:
+            self._tokens[record.id] = record
+        return records
+    
+    async def update_balance(self, token_id: int, remaining_traffic: int, checked_at: Optional[str] = None):
+        """Record a fresh balance reading for one token"""
+        await self.update_balances([(token_id, remaining_traffic, checked_at or timestamp_now())])
+    
+    async def update_balances(self, updates: List[Tuple[int, int, str]]):
+        """Record (token_id, remaining_traffic, checked_at) readings; persisted on the next flush"""
+        now = time.monotonic()
+        for token_id, remaining_traffic, checked_at in updates:
+            record = self._tokens.get(token_id)
+            if record is None:
+                continue
+            consumed = max(0, (record.remaining_traffic or 0) - remaining_traffic) if record.last_checked else 0
+            record.apply_reading(remaining_traffic, now)
+            record.last_checked = checked_at
+            # Readings buffered for the same token collapse into one sample, so carry its consumption over
+            consumed += self._pending_balances.get(token_id, (0, '', 0))[2]
+            self._pending_balances[token_id] = (remaining_traffic, checked_at, consumed)
+        await self._flush_if_due()
+    
+    async def delete_low_balance(self, token_ids: List[int]) -> List[int]:
+        """Drop tokens whose balance is below the threshold, returning the IDs dropped
+        
+        They leave the cache immediately; the database rows are deleted on the
+        next flush, unless another instance has meanwhile stored a higher balance.
+        """
+        removed = []
+        for token_id in token_ids:
+            record = self._tokens.get(token_id)
+            if record and (record.remaining_traffic or 0) < LOW_BALANCE_THRESHOLD:
+                del self._tokens[token_id]
+                self._pending_deletes.add(token_id)
+                removed.append(token_id)
+        await self._flush_if_due()
+        return removed
+    
+    @property
+    def pending_writes(self) -> int:
+        """Buffered changes not yet written to the database"""
+        return len(self._pending_balances) + len(self._pending_deletes)
+    
+    async def _flush_if_due(self):
+        if WRITE_BEHIND_INTERVAL <= 0 or self.pending_writes >= WRITE_BEHIND_MAX_PENDING:
+            await self.flush()
+    
+    async def flush(self):
+        """Write every buffered reading and removal in one transaction
+        
+        On failure the changes go back into the buffer (unless superseded) and
+        are retried on the next flush.
+        """
+        async with self._flush_lock:
+            if not self.pending_writes:
+                return
+            balances, self._pending_balances = self._pending_balances, {}
+            deletes, self._pending_deletes = self._pending_deletes, set()
+            self._deleting = deletes
+            updates = [(token_id, remaining, checked_at) for token_id, (remaining, checked_at, _) in balances.items()]
+            samples = [
+                (token_id, checked_at, remaining, consumed)
+                for token_id, (remaining, checked_at, consumed) in balances.items()
+            ]
+            
+            try:
+                updated, deleted = await self.db.write_batch(updates, sorted(deletes), samples)
+            except Exception as e:
+                logger.error(f"Error flushing {len(updates)} balance(s) and {len(deletes)} removal(s): {e}")
+                for token_id, (remaining, checked_at, consumed) in balances.items():
+                    newer = self._pending_balances.get(token_id)
+                    if newer:
+                        self._pending_balances[token_id] = (newer[0], newer[1], newer[2] + consumed)
+                    else:
+                        self._pending_balances[token_id] = (remaining, checked_at, consumed)
+                self._pending_deletes |= deletes
+                return
+            finally:
+                self._deleting = set()
+            
+            metrics.inc('write_behind_flushes_total')
+            if len(updates) > 1 or deletes:
+                logger.info(
+                    f"Flushed {updated}/{len(updates)} balance(s) and {deleted}/{len(deletes)} removal(s) in one transaction"
+                )
+    
+    async def delete(self, token_id: int) -> bool:
+        """Delete one token"""
+        if not await self.db.delete_token(token_id):
+            return False
+        self._tokens.pop(token_id, None)
+        self._pending_balances.pop(token_id, None)
+        return True
+    
+    async def delete_first(self) -> bool:
+        """Delete the first (oldest) token"""
+        record = self.first()
+        if record:
+            return await self.delete(record.id)
+        return False
+    
+    async def delete_all(self) -> bool:
+        """Delete every token"""
+        if not await self.db.delete_all_tokens():
+            return False
+        self._tokens.clear()
+        self._pending_balances.clear()
+        self._pending_deletes.clear()
+        return True
+
+
+# Initialize database and token registry
 db = Database()
+registry = TokenRegistry(db)
+metrics.register_gauge('tokens', lambda: len(registry))
+metrics.register_gauge('write_behind_pending', lambda: registry.pending_writes)
+
+
+class OrderLedger:
+    """Buffers one ledger row per order and appends them to the orders table in the background
+    
+    record() never touches the database, so logging an order adds nothing to
+    the /get response time.
+    """
+    
+    def __init__(self, database: Database):
+        self.db = database
+        self._pending: List[Tuple] = []
+        self._flush_lock = asyncio.Lock()
+    
+    def record(self, user, country_code: str, requested: int, delivered: int, outcome: str,
+               token_counts: Dict[int, int], duration: float):
+        """Queue one order for the ledger"""
+        tokens = ";".join(f"{token_id}:{count}" for token_id, count in token_counts.items())
+        self._pending.append((
+            timestamp_now(), user.id, user.username, country_code, requested, delivered,
+            outcome, tokens, int(duration * 1000)
+        ))
+    
+    def __len__(self) -> int:
+        return len(self._pending)
+    
+    async def flush(self):
+        """Append every queued order in one transaction; kept for the next flush on failure"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            orders, self._pending = self._pending, []
+            try:
+                await self.db.add_orders(orders)
+            except Exception as e:
+                logger.error(f"Error writing {len(orders)} order(s) to the ledger: {e}")
+                self._pending = orders + self._pending
+
+
+order_ledger = OrderLedger(db)
+metrics.register_gauge('order_ledger_pending', lambda: len(order_ledger))
 
 
 def get_keyboard(page: int, total_pages: int):
@@ -466,8 +1848,7 @@ def get_keyboard(page: int, total_pages: int):
     keyboard.append(row)
     return InlineKeyboardMarkup(keyboard)
 
-@lru_cache(maxsize=32)
-def get_page_content(page: int, chunk_size: int = 20) -> str:
+def get_page_content(page: int, chunk_size: int = COUNTRY_PAGE_SIZE) -> str:
     """Get the text content for a specific page"""
     start_idx = (page - 1) * chunk_size
     end_idx = start_idx + chunk_size
@@ -480,18 +1861,43 @@ def get_page_content(page: int, chunk_size: int = 20) -> str:
     
     return text
 
+
+# /list pages are rendered once at import: (text, keyboard) per page
+COUNTRY_TOTAL_PAGES = (len(COUNTRY_LIST) + COUNTRY_PAGE_SIZE - 1) // COUNTRY_PAGE_SIZE
+COUNTRY_PAGES: List[Tuple[str, InlineKeyboardMarkup]] = [
+    (get_page_content(page), get_keyboard(page, COUNTRY_TOTAL_PAGES))
+    for page in range(1, COUNTRY_TOTAL_PAGES + 1)
+]
+
+
+def resolve_country(query: str) -> Optional[Tuple[str, str, str, str]]:
+    """Find a COUNTRY_LIST entry by code or by (case-insensitive) name"""
+    query = query.strip()
+    return COUNTRY_INDEX.get(query.upper()) or COUNTRY_INDEX.get(COUNTRY_NAME_INDEX.get(query.lower(), ''))
+
+
+def suggest_countries(query: str, limit: int = 3) -> List[Tuple[str, str, str, str]]:
+    """Closest matching countries for a code or name that did not resolve"""
+    query = query.strip()
+    codes = difflib.get_close_matches(query.upper(), COUNTRY_INDEX.keys(), n=limit, cutoff=0.5)
+    names = difflib.get_close_matches(query.lower(), COUNTRY_NAME_INDEX.keys(), n=limit, cutoff=0.6)
+    
+    suggestions = []
+    for code in [COUNTRY_NAME_INDEX[name] for name in names] + codes:
+        if code not in suggestions:
+            suggestions.append(code)
+    return [COUNTRY_INDEX[code] for code in suggestions[:limit]]
+
+
+@instrumented('list')
 async def list_countries(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show a full list of country short codes with click-to-copy formatting."""
-    chunk_size = 20
-    total_pages = (len(COUNTRY_LIST) + chunk_size - 1) // chunk_size
-    current_page = 1
-    
-    text = get_page_content(current_page, chunk_size)
-    reply_markup = get_keyboard(current_page, total_pages)
+    text, reply_markup = COUNTRY_PAGES[0]
     
     await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
 
 
+@instrumented('list_page')
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle pagination button clicks"""
     query = update.callback_query
@@ -501,11 +1907,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     page = int(query.data.split("_")[1])
-    chunk_size = 20
-    total_pages = (len(COUNTRY_LIST) + chunk_size - 1) // chunk_size
+    if not 1 <= page <= COUNTRY_TOTAL_PAGES:
+        return
     
-    text = get_page_content(page, chunk_size)
-    reply_markup = get_keyboard(page, total_pages)
+    text, reply_markup = COUNTRY_PAGES[page - 1]
     
     try:
         await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
@@ -513,10 +1918,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"Error editing message: {e}")
 
 
-
-
-
-
+@instrumented('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a welcome message with user guide"""
     user = update.effective_user
@@ -532,19 +1934,24 @@ This bot helps you manage proxy tokens and provide automated balance checking\\.
 
 📋 *Admin Commands:*
 • /add \\- Add a new Token and UserID 🔒
+• /import \\- Bulk add tokens from a `token,userid` file 🔒
 • /del \\- Delete the first \\(oldest\\) token 🔒
 • /delall \\- Delete all tokens from the database 🔒
-• /showall \\- View all stored tokens with balances 🔒
+• /showall \\[low\\|stale\\] \\- Browse stored tokens with balances 🔒
 • /checkall \\- Manually trigger balance check for all tokens 🔒
+• /metrics \\- Show latency and throughput metrics 🔒
+• /trends \\[token\\_id\\|all\\] \\[days\\] \\- Show traffic consumption trends 🔒
+• /orders \\[days\\] \\- Export the orders ledger as CSV 🔒
+• /profile \\[seconds\\|stop\\] \\- Profile the bot and get a report 🔒
 
 📋 *User Commands:*
 • /get \\[country\\] \\[count\\] \\- Generate proxies
 • /list \\- View all available country codes
 
 *Automatic Features:*
-• Balance is checked every hour automatically
+• Balances are polled automatically, more often for busy tokens
 • Tokens with less than 50 MB remaining are auto\\-removed
-• First token in queue is always used for proxy generation
+• Proxy generation is spread across all tokens with enough balance
 
 💡 *Quick Start:*
 1️⃣ Add token & userid using /add
@@ -618,19 +2025,21 @@ async def userid_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     userid = update.message.text.strip()
     token = context.user_data.get('token')
     
-    if db.add_token(token, userid):
+    record = await registry.add(token, userid)
+    
+    if record:
         # Check balance immediately
         balance_data = await ProxyAPI.check_balance(token, userid)
         
         if balance_data:
             remaining = balance_data.get('remainingTraffic', 0)
-            db.update_balance(db.get_first_token()[0], remaining)
+            await registry.update_balance(record.id, remaining)
             
             await update.message.reply_text(
                 f"✅ *Token Added Successfully\\!*\n\n"
                 f"*UserID:* `{userid}`\n"
                 f"*Remaining Traffic:* {remaining} MB\n"
-                f"*Total Tokens:* {db.count_tokens()}\n\n"
+                f"*Total Tokens:* {len(registry)}\n\n"
                 f"Your token is now active and ready to use\\!",
                 parse_mode='MarkdownV2'
             )
@@ -662,115 +2071,891 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def get_proxy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Generate proxies based on user request"""
-    # Parse arguments
-    args = context.args
+def parse_import(content: str, existing: set) -> Tuple[List[Tuple[int, str, str]], List[Tuple[int, str]]]:
+    """Parse `token,userid` lines into accepted (line, token, userid) and rejected (line, reason) entries
     
-    if len(args) < 1:
-        await update.message.reply_text(
-            "❌ *Invalid Usage\\!*\n\n"
-            "*Correct format:* /get \\[country\\] \\[count\\]\n\n"
-            "*Examples:*\n"
-            "• /get IN 5 \\- Generate 5 Indian proxies\n"
-            "• /get US 1 \\- Generate 1 US proxy\n"
-            "• /get GB 3 \\- Generate 3 UK proxies",
-            parse_mode='MarkdownV2'
-        )
-        return
+    Blank lines and lines starting with # are ignored. Tokens already stored or
+    repeated earlier in the file are rejected.
+    """
+    accepted: List[Tuple[int, str, str]] = []
+    rejected: List[Tuple[int, str]] = []
+    seen = set()
     
-    # Parse country code
-    country_code = args[0].upper()
+    for line_no, line in enumerate(content.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        
+        parts = [part.strip() for part in (line.split(',') if ',' in line else line.split())]
+        if len(parts) != 2 or not all(parts):
+            rejected.append((line_no, "expected token,userid"))
+            continue
+        
+        token, userid = parts
+        if token in existing:
+            rejected.append((line_no, "already stored"))
+        elif token in seen:
+            rejected.append((line_no, "duplicate in file"))
+        else:
+            seen.add(token)
+            accepted.append((line_no, token, userid))
+    
+    return accepted, rejected
+
+
+async def import_tokens(entries: List[Tuple[int, str, str]]) -> Dict[str, Any]:
+    """Insert parsed entries in one transaction, then validate their balances concurrently
+    
+    Tokens whose balance is already below the threshold are removed again.
+    Returns counts plus the (line, reason) of every token rejected here.
+    """
+    result = {'added': 0, 'verified': 0, 'unverified': 0, 'rejected': []}
+    records = await registry.add_many([(token, userid) for _, token, userid in entries])
+    result['added'] = len(records)
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    
+    async def check(record: TokenRecord):
+        async with semaphore:
+            balance_data = await ProxyAPI.check_balance(record.token, record.userid)
+            return balance_data, timestamp_now()
+    
+    checks = await asyncio.gather(*(check(record) for record in records))
+    
+    updates: List[Tuple[int, int, str]] = []
+    low: Dict[int, Tuple[int, int]] = {}
+    for (line_no, _, _), record, (balance_data, checked_at) in zip(entries, records, checks):
+        if not balance_data:
+            result['unverified'] += 1
+            continue
+        remaining = balance_data.get('remainingTraffic', 0)
+        updates.append((record.id, remaining, checked_at))
+        if remaining < LOW_BALANCE_THRESHOLD:
+            low[record.id] = (line_no, remaining)
+        else:
+            result['verified'] += 1
     
-    # Parse count (default 1)
-    count = 1
-    if len(args) > 1:
-        try:
-            count = int(args[1])
-            if count < 1 or count > 50:
-                await update.message.reply_text(
-                    "❌ *Invalid count\\!*\n\n"
-                    "Please specify a count between 1 and 50\\.",
-                    parse_mode='MarkdownV2'
-                )
-                return
-        except ValueError:
-            await update.message.reply_text(
-                "❌ *Invalid count format\\!*\n\n"
-                "Please use a number \\(e\\.g\\., /get IN 5\\)",
-                parse_mode='MarkdownV2'
-            )
-            return
+    await registry.update_balances(updates)
+    for token_id in await registry.delete_low_balance(list(low)):
+        line_no, remaining = low[token_id]
+        result['added'] -= 1
+        result['rejected'].append((line_no, f"low balance ({remaining} MB)"))
     
-    # Get first token
-    first_token = db.get_first_token()
+    return result
+
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start the bulk import conversation - Admin only"""
+    user = update.effective_user
     
-    if not first_token:
+    # Check if user is admin
+    if user.id != ADMIN_USER_ID:
         await update.message.reply_text(
-            "❌ *No tokens available\\!*\n\n"
-            "Please add a token using /add first\\.",
+            "🔒 *Access Denied*\n\n"
+            "This command is only available to the bot administrator\\.",
             parse_mode='MarkdownV2'
         )
-        return
+        return ConversationHandler.END
     
-    token_id, token, userid = first_token
-    
-    # Send processing message
-    processing_msg = await update.message.reply_text(
-        f"⏳ Generating {count} proxy\\(ies\\) for *{country_code}*\\.\\.\\.",
+    await update.message.reply_text(
+        "📥 *Bulk Token Import*\n\n"
+        "Send me a text file with one `token,userid` per line\\.\n"
+        "Blank lines and lines starting with \\# are skipped\\.\n\n"
+        "Use /cancel to cancel this operation\\.",
         parse_mode='MarkdownV2'
     )
+    return IMPORT_FILE
+
+
+@instrumented('import')
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Receive the import file, store its tokens and reply with one summary"""
+    document = update.message.document
+    
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ File is too large \\(limit {IMPORT_MAX_BYTES // 1024} KB\\)\\. Send a smaller file or /cancel\\.",
+            parse_mode='MarkdownV2'
+        )
+        return IMPORT_FILE
+    
+    status_msg = await update.message.reply_text("⏳ Importing tokens...")
+    
+    telegram_file = await document.get_file()
+    content = bytes(await telegram_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+    
+    existing = {row[1] for row in await db.get_all_tokens()}
+    entries, rejected = parse_import(content, existing)
+    
+    lines_read = len(entries) + len(rejected)
     
-    # Create proxies
-    proxy_data = await ProxyAPI.create_proxy(token, userid, country_code, count)
+    result = await import_tokens(entries)
+    rejected = sorted(rejected + result['rejected'])
     
-    if proxy_data:
-        # Delete processing message
+    summary = (
+        f"✅ Import finished\n\n"
+        f"📄 Lines read: {lines_read}\n"
+        f"➕ Added: {result['added']}\n"
+        f"   ✅ Balance verified: {result['verified']}\n"
+        f"   ⚠️ Not verified yet: {result['unverified']}\n"
+        f"❌ Rejected: {len(rejected)}\n"
+        f"🔢 Total tokens: {len(registry)}"
+    )
+    if rejected:
+        summary += "\n\nRejected lines:\n"
+        summary += "\n".join(f"• line {line_no}: {reason}" for line_no, reason in rejected[:IMPORT_REPORT_LINES])
+        if len(rejected) > IMPORT_REPORT_LINES:
+            summary += f"\n• ...and {len(rejected) - IMPORT_REPORT_LINES} more"
+    
+    await status_msg.edit_text(summary)
+    return ConversationHandler.END
+
+
+async def create_with_failover(country_code: str, count: int) -> Tuple[Optional[List[Dict]], Optional[TokenRecord]]:
+    """Create proxies on the next scheduled token, falling over to another token on failure
+    
+    Returns the proxy list and the token that produced it, or (None, None) once
+    MAX_TOKEN_ATTEMPTS tokens have failed or no usable token is left. Rejected
+    calls count against their tokens unless every token tried rejected the
+    order the same way, in which case the order itself is at fault. A token
+    that fails is scheduled for an early balance check.
+    """
+    tried = set()
+    rejections: List[Tuple[TokenRecord, RequestRejected]] = []
+    proxy_data, record = None, None
+    
+    for _ in range(MAX_TOKEN_ATTEMPTS):
+        candidate = await registry.acquire(exclude=tried)
+        if candidate is None:
+            break
+        tried.add(candidate.id)
+        
         try:
-            await processing_msg.delete()
-        except Exception:
-            pass
+            proxy_data = await ProxyAPI.create_proxy(candidate.token, candidate.userid, country_code, count)
+        except RequestRejected as e:
+            rejections.append((candidate, e))
+        finally:
+            await registry.release(candidate)
+        
+        if proxy_data:
+            record = candidate
+            break
+        # A drained token fails this way; don't wait for its next scheduled poll
+        candidate.next_check_at = None
+        logger.warning(f"Token ID {candidate.id} failed to create proxies for {country_code}, trying next token")
+    
+    request_fault = (
+        record is None and len(rejections) == len(tried)
+        and len({str(e) for _, e in rejections}) == 1
+    )
+    for rejected, e in rejections:
+        ProxyAPI.record_token_outcome(rejected.token, request_fault, e.latency, f"proxy creation: {e}")
+    if request_fault:
+        logger.warning(f"Proxy creation for {country_code} rejected by every token tried: {rejections[0][1]}")
+    
+    if record is None:
+        return None, None
+    return proxy_data, record
+
+
+def split_order(count: int) -> List[int]:
+    """Split an order into near-equal sub-batches of at most ORDER_SPLIT_SIZE proxies"""
+    batches = max(1, -(-count // ORDER_SPLIT_SIZE))
+    size, extra = divmod(count, batches)
+    return [size + (1 if i < extra else 0) for i in range(batches)]
+
+
+class ProxyPool:
+    """Pre-generated proxies for popular countries, refilled in the background
+    
+    Each entry remembers when its credentials expire and which token created it.
+    Entries too close to expiry are discarded rather than handed out.
+    """
+    
+    def __init__(self, countries=WARM_POOL_COUNTRIES, size: int = WARM_POOL_SIZE):
+        self.countries = tuple(countries)
+        self.size = size
+        self._pools: Dict[str, deque] = {country: deque() for country in self.countries}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+    
+    def _prune(self, country_code: str):
+        """Drop entries that expire within WARM_POOL_EXPIRY_MARGIN"""
+        pool = self._pools[country_code]
+        cutoff = time.monotonic() + WARM_POOL_EXPIRY_MARGIN
+        while pool and pool[0][0] <= cutoff:
+            pool.popleft()
+    
+    def available(self, country_code: str) -> int:
+        """Number of fresh proxies ready for a country"""
+        if country_code not in self._pools:
+            return 0
+        self._prune(country_code)
+        return len(self._pools[country_code])
+    
+    def take(self, country_code: str, count: int) -> List[Tuple[Dict, TokenRecord]]:
+        """Remove up to `count` fresh proxies for a country from the pool"""
+        if not self.available(country_code):
+            return []
+        pool = self._pools[country_code]
+        taken = [pool.popleft()[1:] for _ in range(min(count, len(pool)))]
+        if self._wakeup:
+            self._wakeup.set()
+        return taken
+    
+    async def refill(self, country_code: str):
+        """Top one country back up to the configured size"""
+        needed = self.size - self.available(country_code)
+        if needed <= 0:
+            return
+        proxy_data, record = await create_with_failover(country_code, needed)
+        if proxy_data:
+            expires_at = time.monotonic() + PROXY_SESSION_MINUTES * 60
+            self._pools[country_code].extend((expires_at, proxy, record) for proxy in proxy_data)
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if len(registry):
+                results = await asyncio.gather(
+                    *(self.refill(country) for country in self.countries), return_exceptions=True
+                )
+                for country, result in zip(self.countries, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Error refilling proxy pool for {country}: {result}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=WARM_POOL_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def start(self):
+        """Start the background refill task"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Warm proxy pool started for {', '.join(self.countries)}")
+    
+    async def stop(self):
+        """Stop the background refill task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+proxy_pool = ProxyPool()
+metrics.register_gauge('warm_pool_proxies', lambda: sum(proxy_pool.available(c) for c in proxy_pool.countries))
+
+
+class _PendingBatch:
+    """Requests waiting to be merged into one createProxy call"""
+    
+    __slots__ = ('total', 'requests', 'timer')
+    
+    def __init__(self):
+        self.total = 0
+        self.requests: List[Tuple[int, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
 
-        # Send header
-        header = f"✅ *Proxies Generated Successfully\\!*\n"
-        header += f"*Country:* {country_code}\n"
-        header += f"*Count:* {len(proxy_data)}\n"
-        header += f"*UserID:* `{userid}`\n"
-        await update.message.reply_text(header, parse_mode='MarkdownV2')
 
-        # Send proxies in chunks to avoid message length limits
-        chunk_size = 15  # Send 15 proxies per message
-        current_chunk = []
+class RequestCoalescer:
+    """Merge concurrent same-country proxy requests into a single createProxy call
+    
+    The first request for a country opens a batch that stays open for
+    COALESCE_WINDOW seconds. Requests arriving in that window join it, and the
+    batch is sent early once it reaches UPSTREAM_MAX_GOOD_NUM. Each requester
+    then gets its own slice of the combined result.
+    """
+    
+    def __init__(self, window: float = COALESCE_WINDOW, max_batch: int = UPSTREAM_MAX_GOOD_NUM):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[str, _PendingBatch] = {}
+        self._dispatching = set()
+    
+    async def create(self, country_code: str, count: int) -> Tuple[Optional[List[Dict]], Optional[TokenRecord]]:
+        """Same contract as create_with_failover, but possibly shared with other requests"""
+        if count >= self.max_batch:
+            return await create_with_failover(country_code, count)
         
-        for p in proxy_data:
-            proxy_str = f"`{p['proxyHost']}`:`{p['proxyPort']}`:`{p['userName']}`:`{p['password']}`"
-            current_chunk.append(proxy_str)
-            
-            if len(current_chunk) >= chunk_size:
-                await update.message.reply_text("\n".join(current_chunk), parse_mode='MarkdownV2')
-                current_chunk = []
+        batch = self._pending.get(country_code)
+        if batch is not None and batch.total + count > self.max_batch:
+            self._flush(country_code)
+            batch = None
+        if batch is None:
+            batch = self._pending[country_code] = _PendingBatch()
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, country_code)
         
-        # Send remaining proxies
-        if current_chunk:
-            await update.message.reply_text("\n".join(current_chunk), parse_mode='MarkdownV2')
+        future = asyncio.get_running_loop().create_future()
+        batch.requests.append((count, future))
+        batch.total += count
+        if batch.total >= self.max_batch:
+            self._flush(country_code)
         
-        # Check balance after generation
-        balance_data = await ProxyAPI.check_balance(token, userid)
-        if balance_data:
-            remaining = balance_data.get('remainingTraffic', 0)
-            db.update_balance(token_id, remaining)
-            
-            if remaining < 50:
-                db.delete_token(token_id)
+        return await future
+    
+    def _flush(self, country_code: str):
+        batch = self._pending.pop(country_code, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.ensure_future(self._dispatch(country_code, batch))
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+    
+    async def _dispatch(self, country_code: str, batch: _PendingBatch):
+        metrics.inc('coalesced_requests_total', len(batch.requests))
+        if len(batch.requests) > 1:
+            logger.info(f"Coalesced {len(batch.requests)} requests for {country_code} into one call ({batch.total} proxies)")
+        try:
+            proxy_data, record = await create_with_failover(country_code, batch.total)
+        except Exception as e:
+            logger.error(f"Error creating coalesced batch for {country_code}: {e}")
+            proxy_data, record = None, None
+        
+        offset = 0
+        for count, future in batch.requests:
+            share = (proxy_data or [])[offset:offset + count]
+            offset += count
+            if not future.done():
+                future.set_result((share, record) if share else (None, None))
+
+
+coalescer = RequestCoalescer()
+
+
+async def generate_order(country_code: str, count: int):
+    """Create an order as concurrent sub-batches, yielding (proxies, token) as each completes
+    
+    Proxies ready in the warm pool are yielded first. The rest is scheduled as
+    independent sub-batches, so they may land on the same token or on
+    different ones. Failed sub-batches are skipped and the rest of the order is
+    still yielded.
+    """
+    pooled: Dict[int, Tuple[List[Dict], TokenRecord]] = {}
+    for proxy, record in proxy_pool.take(country_code, count):
+        pooled.setdefault(record.id, ([], record))[0].append(proxy)
+        metrics.inc('warm_pool_hits_total')
+    for proxy_data, record in pooled.values():
+        yield proxy_data, record
+    
+    remaining = count - sum(len(proxy_data) for proxy_data, _ in pooled.values())
+    if not remaining:
+        return
+    
+    batches = split_order(remaining)
+    if COALESCE_ENABLED and len(batches) == 1:
+        # Only single-batch orders are coalesced; merging an order's own
+        # sub-batches back together would undo the split
+        tasks = [asyncio.ensure_future(coalescer.create(country_code, remaining))]
+    else:
+        tasks = [asyncio.ensure_future(create_with_failover(country_code, n)) for n in batches]
+    
+    try:
+        for next_batch in asyncio.as_completed(tasks):
+            proxy_data, record = await next_batch
+            if proxy_data:
+                yield proxy_data, record
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class RateLimiter:
+    """Token bucket handing out `rate` permits per second with bursts of up to `burst`
+    
+    reserve() always succeeds and returns how long the caller must wait before
+    using its permit, so concurrent callers are served in reservation order.
+    """
+    
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def reserve(self, cost: float = 1) -> float:
+        """Take `cost` permits, returning the seconds to wait before using them"""
+        self._refill()
+        self._tokens -= cost
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+    
+    def wait_time(self, cost: float = 1) -> float:
+        """Seconds a reserve(cost) made now would have to wait, without taking anything"""
+        self._refill()
+        shortfall = cost - self._tokens
+        return 0.0 if shortfall <= 0 else shortfall / self.rate
+    
+    def pause(self, seconds: float):
+        """Hold back every permit for at least `seconds` (e.g. after a flood-wait)"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class OutboundQueue:
+    """Rate-limit-aware sender for Telegram messages
+    
+    Sends are spaced to stay under SEND_QUEUE_GLOBAL_RATE messages per second
+    overall and SEND_QUEUE_CHAT_RATE per chat (with short bursts allowed).
+    Flood-wait errors pause the chat for the requested time and the send is
+    retried.
+    """
+    
+    def __init__(self):
+        self._global = RateLimiter(SEND_QUEUE_GLOBAL_RATE, SEND_QUEUE_GLOBAL_RATE)
+        self._chats: Dict[int, RateLimiter] = {}
+        self.depth = 0  # Sends waiting or in progress
+    
+    def _chat(self, chat_id: int) -> RateLimiter:
+        if chat_id not in self._chats:
+            self._chats[chat_id] = RateLimiter(SEND_QUEUE_CHAT_RATE, SEND_QUEUE_CHAT_BURST)
+        return self._chats[chat_id]
+    
+    async def send(self, chat_id: int, send_func):
+        """Await `send_func()` once the rate limits allow it, returning its result"""
+        self.depth += 1
+        try:
+            for attempt in range(SEND_QUEUE_MAX_RETRIES + 1):
+                delay = max(self._chat(chat_id).reserve(), self._global.reserve())
+                if delay:
+                    await asyncio.sleep(delay)
+                try:
+                    with metrics.track('telegram_send_seconds'):
+                        return await send_func()
+                except RetryAfter as e:
+                    metrics.inc('telegram_flood_waits_total')
+                    if attempt == SEND_QUEUE_MAX_RETRIES:
+                        raise
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                    logger.warning(f"Flood control for chat {chat_id}, waiting {retry_after}s")
+                    self._chat(chat_id).pause(retry_after)
+        finally:
+            self.depth -= 1
+
+
+outbound = OutboundQueue()
+metrics.register_gauge('send_queue_depth', lambda: outbound.depth)
+
+
+class QuotaExceeded(Exception):
+    """A user ordered more than their quota allows within GET_QUOTA_MAX_WAIT"""
+    
+    def __init__(self, retry_after: float):
+        super().__init__(f"Quota exceeded, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """Admission control for proxy orders
+    
+    At most GET_MAX_CONCURRENT_ORDERS orders generate at once, and at most
+    GET_USER_MAX_CONCURRENT per user. Each user has a token bucket measured in
+    proxies. Orders that cannot start right away wait in per-user FIFO queues
+    that are served round-robin, so one busy user cannot hold everyone else
+    behind a long backlog.
+    """
+    
+    def __init__(self, max_concurrent: int = GET_MAX_CONCURRENT_ORDERS,
+                 user_concurrent: int = GET_USER_MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self.user_concurrent = user_concurrent
+        self.active = 0
+        self._user_active: Dict[int, int] = {}
+        self._queues: Dict[int, deque] = {}
+        self._rotation: deque = deque()  # Users with queued orders, in service order
+        self._quotas: Dict[int, RateLimiter] = {}
+    
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+    
+    def _quota(self, user_id: int) -> RateLimiter:
+        if user_id not in self._quotas:
+            self._quotas[user_id] = RateLimiter(GET_USER_PROXY_RATE, GET_USER_PROXY_BURST)
+        return self._quotas[user_id]
+    
+    def _can_start(self, user_id: int) -> bool:
+        return self.active < self.max_concurrent and self._user_active.get(user_id, 0) < self.user_concurrent
+    
+    def _start(self, user_id: int):
+        self.active += 1
+        self._user_active[user_id] = self._user_active.get(user_id, 0) + 1
+    
+    def position(self, user_id: int, future: asyncio.Future) -> int:
+        """Estimated place in line: orders served before this one under round-robin, plus one"""
+        queue = self._queues.get(user_id)
+        if not queue or future not in queue:
+            return 0
+        rank = queue.index(future) + 1
+        ahead = rank - 1
+        for other, other_queue in self._queues.items():
+            if other != user_id:
+                ahead += min(len(other_queue), rank)
+        return ahead + 1
+    
+    async def acquire(self, user_id: int, cost: int, on_position=None, on_quota_wait=None):
+        """Wait for a slot to generate `cost` proxies for `user_id`
+        
+        Raises QuotaExceeded if the user's quota would not allow the order
+        within GET_QUOTA_MAX_WAIT. `on_quota_wait`, if given, is awaited with the
+        delay in seconds before the order waits for quota; `on_position` is
+        awaited with the queue position while it waits for a slot. Every
+        successful acquire must be paired with a release().
+        """
+        quota = self._quota(user_id)
+        wait = quota.wait_time(cost)
+        if wait > GET_QUOTA_MAX_WAIT:
+            metrics.inc('orders_rejected_total', reason='quota')
+            raise QuotaExceeded(wait)
+        delay = quota.reserve(cost)
+        if delay:
+            if on_quota_wait:
+                try:
+                    await on_quota_wait(delay)
+                except Exception as e:
+                    logger.warning(f"Error reporting quota wait: {e}")
+            await asyncio.sleep(delay)
+        
+        if self._can_start(user_id) and not self.waiting:
+            self._start(user_id)
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(user_id, deque())
+        queue.append(future)
+        if user_id not in self._rotation:
+            self._rotation.append(user_id)
+        self._dispatch()
+        
+        last_position = None
+        try:
+            with metrics.track('get_queue_wait_seconds'):
+                while not future.done():
+                    position = self.position(user_id, future)
+                    if on_position and position != last_position:
+                        last_position = position
+                        try:
+                            await on_position(position)
+                        except Exception as e:
+                            logger.warning(f"Error reporting queue position: {e}")
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), timeout=GET_QUEUE_UPDATE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # The slot was granted while we were being cancelled; hand it on
+                self.release(user_id)
+            else:
+                future.cancel()
+                self._discard(user_id, future)
+            raise
+    
+    def release(self, user_id: int):
+        """Free the slot taken by acquire() and start the next queued order"""
+        self.active -= 1
+        self._user_active[user_id] -= 1
+        if not self._user_active[user_id]:
+            del self._user_active[user_id]
+        self._dispatch()
+    
+    def _discard(self, user_id: int, future: asyncio.Future):
+        queue = self._queues.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+        if queue is not None and not queue:
+            del self._queues[user_id]
+            if user_id in self._rotation:
+                self._rotation.remove(user_id)
+    
+    def _dispatch(self):
+        """Grant free slots to queued orders, taking one order per user in turn"""
+        skipped = 0
+        while self.active < self.max_concurrent and self._rotation and skipped < len(self._rotation):
+            user_id = self._rotation[0]
+            self._rotation.rotate(-1)
+            if not self._can_start(user_id):
+                skipped += 1
+                continue
+            skipped = 0
+            queue = self._queues[user_id]
+            future = queue.popleft()
+            if not queue:
+                del self._queues[user_id]
+                self._rotation.remove(user_id)
+            self._start(user_id)
+            future.set_result(None)
+
+
+scheduler = FairScheduler()
+metrics.register_gauge('orders_active', lambda: scheduler.active)
+metrics.register_gauge('orders_queued', lambda: scheduler.waiting)
+
+
+async def queued_reply(update: Update, text: str, **kwargs):
+    """reply_text through the outbound queue"""
+    return await outbound.send(update.effective_chat.id, partial(update.message.reply_text, text, **kwargs))
+
+
+async def send_proxy_chunks(update: Update, proxy_data: List[Dict]):
+    """Send proxies in chunks to avoid message length limits"""
+    chunk_size = 15  # Send 15 proxies per message
+    current_chunk = []
+    
+    for p in proxy_data:
+        proxy_str = f"`{p['proxyHost']}`:`{p['proxyPort']}`:`{p['userName']}`:`{p['password']}`"
+        current_chunk.append(proxy_str)
+        
+        if len(current_chunk) >= chunk_size:
+            await queued_reply(update, "\n".join(current_chunk), parse_mode='MarkdownV2')
+            current_chunk = []
+    
+    # Send remaining proxies
+    if current_chunk:
+        await queued_reply(update, "\n".join(current_chunk), parse_mode='MarkdownV2')
+
+
+def build_proxy_file(proxy_data: List[Dict], country_code: str) -> Tuple[bytes, str]:
+    """Render proxies as a txt (protocol://ip:port:user:pass per line) or CSV file"""
+    lines = [f"{p.get('proxyType') or 'socks5'}://{ProxyAPI.format_proxy(p)}" for p in proxy_data]
+    filename = f"proxies_{country_code}_{len(proxy_data)}_{datetime.now():%Y%m%d_%H%M%S}.{DELIVERY_DOCUMENT_FORMAT}"
+    
+    if DELIVERY_DOCUMENT_FORMAT == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['proxy', 'host', 'port', 'username', 'password'])
+        for line, p in zip(lines, proxy_data):
+            writer.writerow([line, p['proxyHost'], p['proxyPort'], p['userName'], p['password']])
+        return buffer.getvalue().encode(), filename
+    
+    return ("\n".join(lines) + "\n").encode(), filename
+
+
+async def send_proxy_document(update: Update, proxy_data: List[Dict], country_code: str, caption: str):
+    """Send a whole order as a single file"""
+    content, filename = build_proxy_file(proxy_data, country_code)
+    await outbound.send(
+        update.effective_chat.id,
+        partial(update.message.reply_document, document=content, filename=filename,
+                caption=caption, parse_mode='MarkdownV2')
+    )
+
+
+def generation_header(country_code: str, count: int, userid: str) -> str:
+    """MarkdownV2 header sent with a successful order"""
+    header = f"✅ *Proxies Generated Successfully\\!*\n"
+    header += f"*Country:* {country_code}\n"
+    header += f"*Count:* {count}\n"
+    header += f"*UserID:* `{userid}`\n"
+    return header
+
+
+async def refresh_token_balance(update: Update, record: TokenRecord, proxies: int):
+    """Account for generated proxies and re-check the token only when its estimate needs it
+    
+    The token is removed if the authoritative balance fell below the threshold.
+    """
+    record.record_usage(proxies)
+    if record.reconciling or not record.needs_reconcile():
+        return
+    
+    record.reconciling = True
+    try:
+        balance_data = await ProxyAPI.check_balance(record.token, record.userid)
+        checked_at = timestamp_now()
+    finally:
+        record.reconciling = False
+    
+    if balance_data:
+        remaining = balance_data.get('remainingTraffic', 0)
+        await registry.update_balance(record.id, remaining, checked_at)
+        
+        if remaining < LOW_BALANCE_THRESHOLD and await registry.delete_low_balance([record.id]):
+            metrics.inc('tokens_removed_total', reason='low_balance')
+            await queued_reply(
+                update,
+                f"⚠️ *Token Removed*\n\n"
+                f"Remaining traffic was {remaining} MB \\(below 50 MB threshold\\)\\.\n"
+                f"Token has been removed from the database\\.",
+                parse_mode='MarkdownV2'
+            )
+
+
+@instrumented('get')
+async def get_proxy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Generate proxies based on user request"""
+    # Parse arguments
+    args = context.args
+    
+    if len(args) < 1:
+        await update.message.reply_text(
+            "❌ *Invalid Usage\\!*\n\n"
+            "*Correct format:* /get \\[country\\] \\[count\\]\n\n"
+            "*Examples:*\n"
+            "• /get IN 5 \\- Generate 5 Indian proxies\n"
+            "• /get US 1 \\- Generate 1 US proxy\n"
+            "• /get GB 3 \\- Generate 3 UK proxies",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    # Parse country code (a country name works too)
+    country = resolve_country(args[0])
+    
+    if not country:
+        suggestions = suggest_countries(args[0])
+        text = f"❌ *Unknown country:* `{escape_markdown(args[0], version=2, entity_type='code')}`\n\n"
+        if suggestions:
+            text += "*Did you mean:*\n"
+            for flag, name, code, _ in suggestions:
+                text += f"{flag} `{code}` \\- {escape_markdown(name, version=2)}\n"
+            text += "\n"
+        text += "Use /list to see all country codes\\."
+        await update.message.reply_text(text, parse_mode='MarkdownV2')
+        return
+    
+    country_code = country[2]
+    
+    # Parse count (default 1)
+    count = 1
+    if len(args) > 1:
+        try:
+            count = int(args[1])
+            if count < 1 or count > 50:
                 await update.message.reply_text(
-                    f"⚠️ *Token Removed*\n\n"
-                    f"Remaining traffic was {remaining} MB \\(below 50 MB threshold\\)\\.\n"
-                    f"Token has been removed from the database\\.",
+                    "❌ *Invalid count\\!*\n\n"
+                    "Please specify a count between 1 and 50\\.",
                     parse_mode='MarkdownV2'
                 )
+                return
+        except ValueError:
+            await update.message.reply_text(
+                "❌ *Invalid count format\\!*\n\n"
+                "Please use a number \\(e\\.g\\., /get IN 5\\)",
+                parse_mode='MarkdownV2'
+            )
+            return
+    
+    if not len(registry):
+        await update.message.reply_text(
+            "❌ *No tokens available\\!*\n\n"
+            "Please add a token using /add first\\.",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    user_id = update.effective_user.id
+    processing_msg = None
+    
+    async def show_status(text: str):
+        nonlocal processing_msg
+        if processing_msg is None:
+            processing_msg = await queued_reply(update, text, parse_mode='MarkdownV2')
+        else:
+            await outbound.send(update.effective_chat.id, partial(processing_msg.edit_text, text, parse_mode='MarkdownV2'))
+    
+    async def show_position(position: int):
+        await show_status(
+            f"🕒 Your order for {count} *{country_code}* proxy\\(ies\\) is queued\\.\n"
+            f"Position in queue: *{position}*"
+        )
+    
+    async def show_quota_wait(delay: float):
+        await show_status(
+            f"⏳ You've ordered a lot of proxies recently\\. "
+            f"Your order for {count} *{country_code}* proxy\\(ies\\) will start in about {int(delay) + 1} seconds\\."
+        )
+    
+    try:
+        await scheduler.acquire(user_id, count, on_position=show_position, on_quota_wait=show_quota_wait)
+    except QuotaExceeded as e:
+        await update.message.reply_text(
+            f"⏳ *Slow down\\!*\n\n"
+            f"You've ordered a lot of proxies recently\\. "
+            f"Try again in about {int(e.retry_after) + 1} seconds\\.",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    try:
+        # Send processing message
+        await show_status(f"⏳ Generating {count} proxy\\(ies\\) for *{country_code}*\\.\\.\\.")
+        
+        await fulfil_order(update, country_code, count, processing_msg)
+    finally:
+        scheduler.release(user_id)
+
+
+async def fulfil_order(update: Update, country_code: str, count: int, processing_msg):
+    """Generate an order, deliver it and account for it once the scheduler has admitted it"""
+    # Large orders go out as one file once complete, smaller ones as messages while they arrive
+    started = time.monotonic()
+    document_mode = count > DELIVERY_DOCUMENT_THRESHOLD
+    collected: List[Dict] = []
+    first_userid = None
+    delivered = 0
+    used_tokens: Dict[int, Tuple[TokenRecord, int]] = {}
+    
+    async for proxy_data, record in generate_order(country_code, count):
+        if first_userid is None:
+            first_userid = record.userid
+        
+        if document_mode:
+            collected.extend(proxy_data)
+        else:
+            if not delivered:
+                # Delete processing message
+                try:
+                    await processing_msg.delete()
+                except Exception:
+                    pass
+                await queued_reply(update, generation_header(country_code, count, record.userid), parse_mode='MarkdownV2')
+            await send_proxy_chunks(update, proxy_data)
+        
+        delivered += len(proxy_data)
+        _, generated = used_tokens.get(record.id, (record, 0))
+        used_tokens[record.id] = (record, generated + len(proxy_data))
+    
+    outcome = 'failed' if not delivered else 'partial' if delivered < count else 'success'
+    metrics.inc('proxies_delivered_total', delivered)
+    metrics.inc('orders_total', outcome=outcome)
+    order_ledger.record(
+        update.effective_user, country_code, count, delivered, outcome,
+        {token_id: generated for token_id, (_, generated) in used_tokens.items()},
+        time.monotonic() - started
+    )
+    
+    if delivered:
+        if document_mode:
+            try:
+                await processing_msg.delete()
+            except Exception:
+                pass
+            await send_proxy_document(update, collected, country_code, generation_header(country_code, delivered, first_userid))
+        
+        if delivered < count:
+            await queued_reply(
+                update,
+                f"⚠️ *Partial Order*\n\n"
+                f"Only {delivered} of {count} proxies could be generated\\.",
+                parse_mode='MarkdownV2'
+            )
+        
+        # Check balance after generation
+        await asyncio.gather(*(
+            refresh_token_balance(update, record, proxies) for record, proxies in used_tokens.values()
+        ))
     else:
         await processing_msg.delete()
-        await update.message.reply_text(
+        await queued_reply(
+            update,
             "❌ *Proxy Generation Failed\\!*\n\n"
             "Could not create proxies\\. Please check:\n"
             "• Token is valid\n"
@@ -780,6 +2965,7 @@ async def get_proxy(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@instrumented('del')
 async def delete_first(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete the first token - Admin only"""
     user = update.effective_user
@@ -793,7 +2979,7 @@ async def delete_first(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    first_token = db.get_first_token()
+    first_token = registry.first()
     
     if not first_token:
         await update.message.reply_text(
@@ -803,10 +2989,10 @@ async def delete_first(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    token_id, token, userid = first_token
+    userid = first_token.userid
     
-    if db.delete_first_token():
-        remaining_count = db.count_tokens()
+    if await registry.delete(first_token.id):
+        remaining_count = len(registry)
         await update.message.reply_text(
             f"✅ *Token Deleted\\!*\n\n"
             f"*UserID:* `{userid}`\n"
@@ -821,6 +3007,7 @@ async def delete_first(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@instrumented('delall')
 async def delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete all tokens - Admin only"""
     user = update.effective_user
@@ -834,7 +3021,7 @@ async def delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    count = db.count_tokens()
+    count = len(registry)
     
     if count == 0:
         await update.message.reply_text(
@@ -843,7 +3030,7 @@ async def delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    if db.delete_all_tokens():
+    if await registry.delete_all():
         await update.message.reply_text(
             f"✅ *All Tokens Deleted\\!*\n\n"
             f"Removed {count} token\\(s\\) from the database\\.",
@@ -857,8 +3044,85 @@ async def delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def format_health(token: str) -> str:
+    """One-line MarkdownV2 health summary for a token"""
+    health = token_health.get(token)
+    if health.quarantined_until is not None:
+        status = "🚫 quarantined"
+    elif health.success_rate is None:
+        status = "no calls yet"
+    else:
+        status = f"{health.success_rate:.0%} ok, {health.latency:.1f}s"
+    if health.last_error:
+        status += f", last error: {health.last_error[:80]}"
+    return escape_markdown(status, version=2)
+
+
+SHOWALL_FILTERS = {
+    'all': "All Tokens",
+    'low': f"Low Balance (≤{SHOWALL_LOW_BALANCE} MB)",
+    'stale': "Stale Checks",
+}
+
+
+def format_token_entry(token_id: int, token: str, userid: str, remaining: Optional[int], last_checked: Optional[str]) -> str:
+    """MarkdownV2 block describing one token"""
+    # Mask token
+    masked_token = f"{token[:8]}{'*' * 12}{token[-4:]}" if len(token) > 12 else f"{token[:4]}{'*' * 8}"
+    
+    # Format last checked
+    checked_time = "Never"
+    if last_checked:
+        checked_time = str(last_checked).split('.')[0]  # Remove microseconds
+        checked_time = checked_time.replace('-', '\\-').replace('.', '\\.')
+    
+    text = f"*Token ID {token_id}*\n"
+    text += f"   Token: `{escape_markdown(masked_token, version=2, entity_type='code')}`\n"
+    text += f"   UserID: `{escape_markdown(userid, version=2, entity_type='code')}`\n"
+    text += f"   Balance: {remaining if remaining else 'Unknown'} MB\n"
+    text += f"   Last Checked: {checked_time}\n"
+    text += f"   Health: {format_health(token)}\n\n"
+    return text
+
+
+async def render_token_page(token_filter: str = 'all', cursor: int = 0, forward: bool = True) -> Tuple[str, InlineKeyboardMarkup]:
+    """Build the text and navigation keyboard for one /showall page"""
+    # Page straight from the database, so buffered balances and removals go first
+    await registry.flush()
+    rows, has_previous, has_next = await db.get_tokens_page(cursor, forward, SHOWALL_PAGE_SIZE, token_filter)
+    
+    title = escape_markdown(SHOWALL_FILTERS[token_filter], version=2)
+    if token_filter == 'all':
+        title += f" \\({len(registry)} total\\)"
+    text = f"📋 *{title}*\n\n"
+    
+    if rows:
+        text += "".join(format_token_entry(*row) for row in rows)
+    else:
+        text += "No tokens match this filter\\."
+    
+    keyboard = []
+    row = []
+    if has_previous:
+        row.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"sa_{token_filter}_p_{rows[0][0]}"))
+    if has_next:
+        row.append(InlineKeyboardButton("Next ➡️", callback_data=f"sa_{token_filter}_n_{rows[-1][0]}"))
+    if row:
+        keyboard.append(row)
+    keyboard.append([
+        InlineKeyboardButton(("• " if name == token_filter else "") + name.capitalize(), callback_data=f"sa_{name}_n_0")
+        for name in SHOWALL_FILTERS
+    ])
+    
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+@instrumented('showall')
 async def show_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show all tokens with their details - Admin only"""
+    """Show tokens with their details a page at a time - Admin only
+    
+    `/showall low` and `/showall stale` start on a filtered view.
+    """
     user = update.effective_user
     
     # Check if user is admin
@@ -870,9 +3134,7 @@ async def show_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    tokens = db.get_all_tokens()
-    
-    if not tokens:
+    if not len(registry):
         await update.message.reply_text(
             "📋 *No Tokens Found*\n\n"
             "The database is empty\\. Use /add to add a token\\.",
@@ -880,111 +3142,669 @@ async def show_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    response = f"📋 *All Tokens \\({len(tokens)} total\\)*\n\n"
+    token_filter = context.args[0].lower() if context.args else 'all'
+    if token_filter not in SHOWALL_FILTERS:
+        token_filter = 'all'
     
-    for idx, (token_id, token, userid, remaining, last_checked) in enumerate(tokens, 1):
-        # Mask token
-        masked_token = f"{token[:8]}{'*' * 12}{token[-4:]}" if len(token) > 12 else f"{token[:4]}{'*' * 8}"
-        
-        # Format last checked
-        checked_time = "Never"
-        if last_checked:
-            checked_time = str(last_checked).split('.')[0]  # Remove microseconds
-            checked_time = checked_time.replace('-', '\\-').replace('.', '\\.')
+    text, reply_markup = await render_token_page(token_filter)
+    await update.message.reply_text(text, parse_mode='MarkdownV2', reply_markup=reply_markup)
 
-        
-        response += f"*{idx}\\. Token ID {token_id}*\n"
-        response += f"   Token: `{masked_token}`\n"
-        response += f"   UserID: `{userid}`\n"
-        response += f"   Balance: {remaining if remaining else 'Unknown'} MB\n"
-        response += f"   Last Checked: {checked_time}\n\n"
+
+@instrumented('showall_page')
+async def show_all_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /showall navigation and filter buttons - Admin only"""
+    query = update.callback_query
+    
+    if update.effective_user.id != ADMIN_USER_ID:
+        await query.answer("Only the bot administrator can browse tokens.")
+        return
+    await query.answer()
+    
+    _, token_filter, direction, cursor = query.data.split("_")
+    if token_filter not in SHOWALL_FILTERS:
+        return
+    
+    text, reply_markup = await render_token_page(token_filter, int(cursor), direction == 'n')
     
-    await update.message.reply_text(response, parse_mode='MarkdownV2')
+    try:
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=reply_markup)
+    except Exception as e:
+        logger.warning(f"Error editing message: {e}")
 
 
-async def check_balances_task(context: ContextTypes.DEFAULT_TYPE):
-    """Periodic task to check all token balances"""
-    logger.info("Starting automatic balance check...")
+# Held for the whole of a sweep, so this process never runs two at once
+balance_sweep_lock = asyncio.Lock()
+
+
+async def sweep_balances(tokens: List[TokenRecord], progress_callback=None) -> Optional[Dict[str, int]]:
+    """Check balances for many tokens concurrently and persist the results in one transaction
     
-    tokens = db.get_all_tokens()
+    At most SWEEP_CONCURRENCY checks run at once. Results go to the registry's
+    write-behind buffer as they arrive and the buffer is flushed when the sweep
+    ends (and by the periodic flush on long sweeps). `progress_callback`, if
+    given, is awaited with the running stats at most every SWEEP_PROGRESS_INTERVAL
+    seconds.
     
-    if not tokens:
-        logger.info("No tokens to check")
-        return
+    Only one sweep runs at a time across all instances: returns None without
+    checking anything while another sweep, here or elsewhere, holds the lock.
+    """
+    if balance_sweep_lock.locked():
+        logger.info("A balance sweep is already running, skipping")
+        return None
+    
+    async with balance_sweep_lock:
+        if not await db.acquire_lock('balance_sweep'):
+            logger.info("Another instance is sweeping balances, skipping")
+            return None
+        try:
+            return await _sweep_balances(tokens, progress_callback)
+        finally:
+            await db.release_lock('balance_sweep')
+
+
+async def _sweep_balances(tokens: List[TokenRecord], progress_callback=None) -> Dict[str, int]:
+    """Run one sweep for sweep_balances() while it holds the sweep lock"""
+    stats = {'total': len(tokens), 'checked': 0, 'updated': 0, 'removed': 0, 'errors': 0}
+    semaphore = asyncio.Semaphore(SWEEP_CONCURRENCY)
     
-    removed_tokens = []
+    async def check(token_id: int, token: str, userid: str):
+        async with semaphore:
+            balance_data = await ProxyAPI.check_balance(token, userid)
+            return token_id, userid, balance_data, timestamp_now()
     
-    for token_id, token, userid, _, _ in tokens:
-        balance_data = await ProxyAPI.check_balance(token, userid)
+    tasks = [asyncio.ensure_future(check(record.id, record.token, record.userid)) for record in tokens]
+    last_progress = last_renewal = time.monotonic()
+    
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            token_id, userid, balance_data, checked_at = await next_result
+            stats['checked'] += 1
+            
+            if balance_data:
+                remaining = balance_data.get('remainingTraffic', 0)
+                await registry.update_balance(token_id, remaining, checked_at)
+                stats['updated'] += 1
+                logger.info(f"Token ID {token_id} (UserID: {userid}): {remaining} MB remaining")
+                
+                if remaining < LOW_BALANCE_THRESHOLD and await registry.delete_low_balance([token_id]):
+                    stats['removed'] += 1
+                    metrics.inc('tokens_removed_total', reason='low_balance')
+                    logger.info(f"Removed token ID {token_id} due to low balance ({remaining} MB)")
+            else:
+                stats['errors'] += 1
+                logger.warning(f"Failed to check balance for token ID {token_id}")
+                record = registry.get(token_id)
+                if record:
+                    record.schedule_check(time.monotonic(), POLL_MIN_INTERVAL)
+            
+            if time.monotonic() - last_renewal >= SWEEP_LOCK_SECONDS / 3:
+                last_renewal = time.monotonic()
+                await db.acquire_lock('balance_sweep')
+            
+            if progress_callback and time.monotonic() - last_progress >= SWEEP_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await progress_callback(stats)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await registry.flush()
+    
+    return stats
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Collects asyncio debug-mode "Executing <Handle> took N seconds" warnings"""
+    
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records: List[str] = []
+    
+    def emit(self, record: logging.LogRecord):
+        message = record.getMessage()
+        if message.startswith('Executing'):
+            self.records.append(f"{datetime.fromtimestamp(record.created):%H:%M:%S.%f}  {message}")
+
+
+class Profiler:
+    """One profiling window: cProfile, tracemalloc and slow-callback detection
+    
+    Everything is installed by start() and removed by stop(), so the bot runs
+    unprofiled outside a window.
+    """
+    
+    # From 3.12 cProfile sits on sys.monitoring: one Profile sees every thread
+    # and a second enabled Profile is refused. Before that it only sees the
+    # thread that enabled it, so the SQLite worker needs its own.
+    SHARED_PROFILE = sys.version_info >= (3, 12)
+    
+    def __init__(self):
+        self.started_at: Optional[float] = None
+        self.window = 0.0
+        self._loop_profile: Optional[cProfile.Profile] = None
+        self._db_profile: Optional[cProfile.Profile] = None
+        self._snapshot = None
+        self._slow_callbacks: Optional[_SlowCallbackHandler] = None
+        self._loop_state: Optional[Tuple[bool, float]] = None
+        self._started_tracemalloc = False
+        self._timer: Optional[asyncio.Task] = None
+    
+    @property
+    def active(self) -> bool:
+        return self.started_at is not None
+    
+    def remaining(self) -> float:
+        """Seconds left in the current window"""
+        return max(0.0, self.window - (time.monotonic() - self.started_at)) if self.active else 0.0
+    
+    async def start(self, seconds: float, on_finish):
+        """Begin collecting; `on_finish()` is awaited once `seconds` have passed
         
-        if balance_data:
-            remaining = balance_data.get('remainingTraffic', 0)
-            db.update_balance(token_id, remaining)
+        If anything fails to install, whatever was installed is removed again
+        and the error is re-raised.
+        """
+        loop = asyncio.get_running_loop()
+        self.started_at = time.monotonic()
+        self.window = seconds
+        
+        try:
+            self._loop_state = (loop.get_debug(), loop.slow_callback_duration)
+            self._slow_callbacks = _SlowCallbackHandler()
+            logging.getLogger('asyncio').addHandler(self._slow_callbacks)
+            loop.slow_callback_duration = PROFILE_SLOW_CALLBACK
+            loop.set_debug(True)
             
-            logger.info(f"Token ID {token_id} (UserID: {userid}): {remaining} MB remaining")
+            self._started_tracemalloc = not tracemalloc.is_tracing()
+            if self._started_tracemalloc:
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self._snapshot = tracemalloc.take_snapshot()
             
-            if remaining < 50:
-                db.delete_token(token_id)
-                removed_tokens.append((userid, remaining))
-                logger.info(f"Removed token ID {token_id} due to low balance ({remaining} MB)")
+            if not self.SHARED_PROFILE:
+                profile = cProfile.Profile()
+                await db._run(profile.enable)
+                self._db_profile = profile
+            profile = cProfile.Profile()
+            profile.enable()
+            self._loop_profile = profile
+        except BaseException:
+            await self._teardown()
+            raise
+        
+        self._timer = asyncio.create_task(self._finish_after(seconds, on_finish))
+    
+    async def _finish_after(self, seconds: float, on_finish):
+        await asyncio.sleep(seconds)
+        self._timer = None
+        try:
+            await on_finish()
+        except Exception as e:
+            logger.error(f"Error finishing profiling window: {e}")
+    
+    async def _teardown(self):
+        """Remove every hook start() installed; safe to call on a partial start"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._loop_profile is not None:
+            self._loop_profile.disable()
+        if self._db_profile is not None:
+            try:
+                await db._run(self._db_profile.disable)
+            except Exception as e:
+                logger.warning(f"Error disabling SQLite thread profiler: {e}")
+        if self._started_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started_tracemalloc = False
+        if self._loop_state is not None:
+            loop = asyncio.get_running_loop()
+            loop.set_debug(self._loop_state[0])
+            loop.slow_callback_duration = self._loop_state[1]
+            self._loop_state = None
+        if self._slow_callbacks is not None:
+            logging.getLogger('asyncio').removeHandler(self._slow_callbacks)
+        self.started_at = None
+        self._loop_profile = self._db_profile = self._snapshot = self._slow_callbacks = None
+    
+    async def stop(self) -> Optional[bytes]:
+        """Stop collecting and return the text report, or None if no window is running
+        
+        The window is marked closed before the first await, so a /profile stop
+        racing the timer gets None instead of tearing down twice.
+        """
+        if not self.active:
+            return None
+        started_at, self.started_at = self.started_at, None
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        
+        self._loop_profile.disable()
+        if self._db_profile is not None:
+            await db._run(self._db_profile.disable)
+        
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        baseline, slow_callbacks = self._snapshot, self._slow_callbacks
+        if self.SHARED_PROFILE:
+            profiles = (("All threads", self._loop_profile),)
+        else:
+            profiles = (("Event loop thread", self._loop_profile), ("SQLite thread", self._db_profile))
+        await self._teardown()
+        
+        duration = time.monotonic() - started_at
+        out = io.StringIO()
+        out.write(f"proxygen profile, {duration:.1f}s window ending {datetime.now():%Y-%m-%d %H:%M:%S}\n\n")
+        
+        for title, profile in profiles:
+            out.write(f"=== {title}: top {PROFILE_TOP_FUNCTIONS} by cumulative time ===\n")
+            stats = pstats.Stats(profile, stream=out)
+            if stats.total_calls:
+                stats.strip_dirs().sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            else:
+                out.write("(no calls)\n\n")
+        
+        out.write(f"=== Slow event loop callbacks (> {PROFILE_SLOW_CALLBACK}s) ===\n")
+        out.write("\n".join(slow_callbacks.records) or "(none)")
+        out.write("\n\n")
+        
+        out.write(f"=== Memory: {current / 1024:.0f} KiB traced now, {peak / 1024:.0f} KiB peak ===\n")
+        out.write(f"Top {PROFILE_TOP_ALLOCATIONS} allocation changes by line:\n")
+        for stat in snapshot.compare_to(baseline, 'lineno')[:PROFILE_TOP_ALLOCATIONS]:
+            out.write(f"{stat}\n")
+        out.write("\n")
+        
+        out.write("=== Metrics at end of window ===\n")
+        out.write(metrics.render_summary())
+        out.write("\n")
+        
+        return out.getvalue().encode()
+
+
+profiler = Profiler()
+
+
+async def send_profile_report(bot, chat_id: int):
+    """Stop the running profiler and send its report as a document"""
+    report = await profiler.stop()
+    if report is None:
+        return
+    await outbound.send(chat_id, partial(
+        bot.send_document, chat_id=chat_id, document=report,
+        filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt",
+        caption="🔬 Profiling report"
+    ))
+
+
+@instrumented('profile')
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Profile the bot for a fixed window and send the report - Admin only
+    
+    Usage: /profile [seconds] starts a window, /profile stop ends it early.
+    """
+    user = update.effective_user
+    
+    # Check if user is admin
+    if user.id != ADMIN_USER_ID:
+        await update.message.reply_text(
+            "🔒 *Access Denied*\n\n"
+            "This command is only available to the bot administrator\\.",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    chat_id = update.effective_chat.id
+    args = context.args
+    
+    if args and args[0].lower() == 'stop':
+        if not profiler.active:
+            await update.message.reply_text("No profiling window is running.")
+            return
+        await send_profile_report(context.bot, chat_id)
+        return
+    
+    if profiler.active:
+        await update.message.reply_text(
+            f"Profiling is already running ({profiler.remaining():.0f}s left). Use /profile stop to end it."
+        )
+        return
+    
+    try:
+        seconds = min(PROFILE_MAX_SECONDS, max(1, int(args[0]))) if args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text(
+            "❌ *Invalid Usage\\!*\n\n"
+            "*Correct format:* /profile \\[seconds\\|stop\\]",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    try:
+        await profiler.start(seconds, partial(send_profile_report, context.bot, chat_id))
+    except Exception as e:
+        logger.error(f"Error starting profiler: {e}")
+        await update.message.reply_text(f"❌ Could not start profiling: {e}")
+        return
+    await update.message.reply_text(
+        f"🔬 Profiling for {seconds}s (cProfile, tracemalloc, slow callbacks > {PROFILE_SLOW_CALLBACK}s). "
+        f"The report will be sent here; /profile stop ends it early."
+    )
+
+
+@instrumented('metrics')
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show latency percentiles, counters and gauges - Admin only"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if user.id != ADMIN_USER_ID:
+        await update.message.reply_text(
+            "🔒 *Access Denied*\n\n"
+            "This command is only available to the bot administrator\\.",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    summary = metrics.render_summary()
+    if len(summary) > 3900:
+        summary = summary[:3900] + "\n..."
+    await update.message.reply_text(f"<pre>{html.escape(summary)}</pre>", parse_mode='HTML')
+
+
+def format_consumption_table(rows: List[Tuple[str, int, int]], days: int) -> Tuple[str, float]:
+    """Daily consumption table plus the average MB/day over the window"""
+    by_day = {bucket[:10]: (consumed or 0, samples or 0) for bucket, consumed, samples in rows}
+    today = datetime.now().date()
+    lines = [f"{'Day':<12}{'Used MB':>10}{'Samples':>9}"]
+    total = 0
+    for offset in range(days - 1, -1, -1):
+        day = (today - timedelta(days=offset)).isoformat()
+        consumed, samples = by_day.get(day, (0, 0))
+        total += consumed
+        lines.append(f"{day:<12}{consumed:>10}{samples:>9}")
+    return "\n".join(lines), total / days
+
+
+@instrumented('trends')
+async def show_trends(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show fleet-wide or per-token consumption trends from the balance history - Admin only
+    
+    Usage: /trends [token_id|all] [days]. Figures cover complete hours only.
+    """
+    user = update.effective_user
+    
+    # Check if user is admin
+    if user.id != ADMIN_USER_ID:
+        await update.message.reply_text(
+            "🔒 *Access Denied*\n\n"
+            "This command is only available to the bot administrator\\.",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    args = context.args
+    token_id = None
+    days = TRENDS_DEFAULT_DAYS
+    try:
+        if args and args[0].lower() != 'all':
+            token_id = int(args[0])
+        if len(args) > 1:
+            days = max(1, min(int(args[1]), 365))
+    except ValueError:
+        await update.message.reply_text(
+            "❌ *Invalid Usage\\!*\n\n"
+            "*Correct format:* /trends \\[token\\_id\\|all\\] \\[days\\]",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    now = datetime.now()
+    since_day = (now.date() - timedelta(days=days - 1)).isoformat() + " 00:00:00"
+    since_hour = (now - timedelta(hours=24)).strftime("%Y-%m-%d %H:00:00")
+    daily = await db.get_consumption('day', since_day, token_id)
+    hourly = await db.get_consumption('hour', since_hour, token_id)
+    table, per_day = format_consumption_table(daily, days)
+    last_24h = sum(consumed or 0 for _, consumed, _ in hourly)
+    
+    if token_id is None:
+        records = registry.all()
+        capacity = sum(max(0, (r.remaining_traffic or 0) - LOW_BALANCE_THRESHOLD) for r in records)
+        lines = [f"Fleet consumption, last {days} day(s)", "", table, ""]
+        lines.append(f"Last 24h:      {last_24h} MB")
+        lines.append(f"Average:       {per_day:.0f} MB/day")
+        lines.append(f"Usable left:   {capacity} MB across {len(records)} token(s)")
+        if per_day > 0:
+            lines.append(f"Runway:        ~{capacity / per_day:.1f} day(s) at this rate")
+        top = await db.get_top_consumers(since_day)
+        if top:
+            lines += ["", "Top tokens:"]
+            lines += [f"  ID {top_id:<8}{consumed:>10} MB" for top_id, consumed in top]
+    else:
+        record = registry.get(token_id)
+        if record is None and not daily:
+            await update.message.reply_text(f"❌ No token or history found for ID {token_id}\\.", parse_mode='MarkdownV2')
+            return
+        lines = [f"Token ID {token_id}, last {days} day(s)", "", table, ""]
+        lines.append(f"Last 24h:      {last_24h} MB")
+        lines.append(f"Average:       {per_day:.0f} MB/day")
+        if record is None:
+            lines.append("Token has since been removed")
         else:
-            logger.warning(f"Failed to check balance for token ID {token_id}")
+            headroom = max(0, (record.remaining_traffic or 0) - LOW_BALANCE_THRESHOLD)
+            lines.append(f"Balance:       {record.remaining_traffic} MB")
+            if per_day > 0:
+                lines.append(f"Runway:        ~{headroom / per_day:.1f} day(s) to the {LOW_BALANCE_THRESHOLD} MB threshold")
+    
+    text = "\n".join(lines)
+    if len(text) > 3900:
+        text = text[:3900] + "\n..."
+    await update.message.reply_text(f"<pre>{html.escape(text)}</pre>", parse_mode='HTML')
+
+
+@instrumented('orders')
+async def export_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the orders ledger as a CSV document - Admin only
+    
+    Usage: /orders [days]. Rows are read ORDER_EXPORT_CHUNK at a time and
+    written to a spooled temp file, so the export never holds the whole
+    ledger in memory.
+    """
+    user = update.effective_user
+    
+    # Check if user is admin
+    if user.id != ADMIN_USER_ID:
+        await update.message.reply_text(
+            "🔒 *Access Denied*\n\n"
+            "This command is only available to the bot administrator\\.",
+            parse_mode='MarkdownV2'
+        )
+        return
+    
+    days = ORDER_EXPORT_DEFAULT_DAYS
+    if context.args:
+        try:
+            days = max(1, int(context.args[0]))
+        except ValueError:
+            await update.message.reply_text(
+                "❌ *Invalid Usage\\!*\n\n"
+                "*Correct format:* /orders \\[days\\]",
+                parse_mode='MarkdownV2'
+            )
+            return
+    
+    # Include orders still waiting in the buffer
+    await order_ledger.flush()
+    since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S.%f")
+    
+    with tempfile.SpooledTemporaryFile(max_size=ORDER_EXPORT_SPOOL_BYTES, mode='w+b') as spool:
+        # Each chunk is formatted in memory and written to the spool as bytes
+        buffer = io.StringIO(newline='')
+        writer = csv.writer(buffer)
+        writer.writerow(['order_id', 'created_at', 'user_id', 'username', 'country', 'requested',
+                         'delivered', 'outcome', 'tokens', 'duration_ms'])
+        
+        rows = 0
+        last_id = 0
+        while True:
+            page = await db.get_orders_page(last_id, since)
+            if not page:
+                break
+            writer.writerows(page)
+            spool.write(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+            rows += len(page)
+            last_id = page[-1][0]
+        
+        if not rows:
+            await update.message.reply_text(f"📭 No orders in the last {days} day(s).")
+            return
+        
+        totals = await db.get_order_totals(since, limit=5)
+        caption = f"🧾 {rows} order(s) from the last {days} day(s)\n\nBusiest countries:\n"
+        caption += "\n".join(f"• {code}: {proxies} proxies in {orders} order(s)" for code, orders, proxies in totals)
+        
+        spool.seek(0)
+        # Hand over the file handle itself so the upload streams from the spool
+        # instead of reading the whole CSV into memory first
+        await update.message.reply_document(
+            document=InputFile(spool, filename=f"orders_{datetime.now():%Y%m%d_%H%M%S}.csv", read_file_handle=False),
+            caption=caption
+        )
+
+
+async def rollup_history_task(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic task to roll up and compact the balance history (one instance at a time)"""
+    if not await db.acquire_lock('history_rollup', ttl=HISTORY_ROLLUP_INTERVAL / 2):
+        return
+    try:
+        hours, removed = await db.rollup_history()
+        logger.info(f"Balance history rollup: {hours} hourly bucket(s) written, {removed} raw reading(s) compacted")
+    except Exception as e:
+        logger.error(f"Error rolling up balance history: {e}")
+
+
+async def check_balances_task(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic task to check the balances of tokens that are due
+    
+    Runs every POLL_TICK seconds. Each token is polled on its own schedule,
+    derived from how fast its balance has been dropping.
+    """
+    tokens = registry.due_for_check()
+    
+    if not tokens:
+        return
+    
+    logger.info(f"Starting automatic balance check for {len(tokens)} due token(s)...")
+    
+    stats = await sweep_balances(tokens)
     
-    if removed_tokens:
-        logger.info(f"Removed {len(removed_tokens)} token(s) due to low balance")
+    if stats is None:
+        return
+    
+    if stats['removed']:
+        logger.info(f"Removed {stats['removed']} token(s) due to low balance")
     
     logger.info("Balance check completed")
 
 
+@instrumented('checkall')
 async def manual_check_balances(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manually trigger balance check for all tokens"""
     status_msg = await update.message.reply_text("🔄 Checking balances for all tokens...")
     
-    tokens = db.get_all_tokens()
+    tokens = registry.all()
     
     if not tokens:
         await status_msg.edit_text("No tokens found in database.")
         return
     
-    updated_count = 0
-    removed_count = 0
-    errors_count = 0
+    async def report_progress(stats: Dict[str, int]):
+        try:
+            await status_msg.edit_text(
+                f"🔄 Checking balances... {stats['checked']}/{stats['total']}\n\n"
+                f"✅ Updated: {stats['updated']}\n"
+                f"🗑️ Removed (<50MB): {stats['removed']}\n"
+                f"⚠️ Errors: {stats['errors']}"
+            )
+        except Exception as e:
+            logger.warning(f"Error updating progress message: {e}")
+    
+    stats = await sweep_balances(tokens, progress_callback=report_progress)
+    
+    if stats is None:
+        await status_msg.edit_text("⏳ A balance check is already running. Try again shortly.")
+        return
     
-    for token_id, token, userid, _, _ in tokens:
-        balance_data = await ProxyAPI.check_balance(token, userid)
-        
-        if balance_data:
-            remaining = balance_data.get('remainingTraffic', 0)
-            db.update_balance(token_id, remaining)
-            updated_count += 1
-            
-            if remaining < 50:
-                db.delete_token(token_id)
-                removed_count += 1
-        else:
-            errors_count += 1
-            
     report = (
         f"✅ Balance check completed!\n\n"
-        f"📊 Checked: {len(tokens)}\n"
-        f"✅ Updated: {updated_count}\n"
-        f"🗑️ Removed (<50MB): {removed_count}\n"
-        f"⚠️ Errors: {errors_count}"
+        f"📊 Checked: {stats['total']}\n"
+        f"✅ Updated: {stats['updated']}\n"
+        f"🗑️ Removed (<50MB): {stats['removed']}\n"
+        f"⚠️ Errors: {stats['errors']}"
     )
     
     await status_msg.edit_text(report)
 
 
-def main():
-    """Start the bot"""
-    # Replace with your bot token
-    BOT_TOKEN = "8226555654:AAEx9UB1-lDoHA5_9I1F55ISU-fkC_Z0Kxk"
+async def flush_writes_task(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic task to write buffered balance readings and removals"""
+    await registry.flush()
+
+
+async def flush_ledger_task(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic task to append buffered orders to the ledger"""
+    await order_ledger.flush()
+
+
+async def refresh_registry_task(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic task to pick up token changes made by other instances"""
+    try:
+        await registry.refresh()
+    except Exception as e:
+        logger.error(f"Error refreshing token registry: {e}")
+
+
+async def post_init(application: Application):
+    """Open shared resources once the application is initialized"""
+    await ProxyAPI.startup()
+    await registry.load()
+    await metrics_exporter.start()
+    if WARM_POOL_ENABLED:
+        await proxy_pool.start()
+
+
+async def post_shutdown(application: Application):
+    """Release shared resources after the application has shut down"""
+    if profiler.active:
+        await profiler.stop()
+    await proxy_pool.stop()
+    await metrics_exporter.stop()
+    await ProxyAPI.shutdown()
+    await registry.flush()
+    await order_ledger.flush()
+    await db.release_all_tokens()
+    await db.close()
+
+
+def build_application(bot_token: str, request=None) -> Application:
+    """Create the application with every handler and job registered
     
+    `request` defaults to an HTTPXRequest with increased timeouts; the benchmark
+    harness passes a fake one instead.
+    """
     # Configure connection with increased timeouts
-    request = HTTPXRequest(connect_timeout=60.0, read_timeout=60.0)
-
+    if request is None:
+        request = HTTPXRequest(connect_timeout=60.0, read_timeout=60.0)
+    
     # Create application
-    application = Application.builder().token(BOT_TOKEN).request(request).build()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .request(request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     
     # Add conversation handler for adding tokens
     add_conv_handler = ConversationHandler(
@@ -996,20 +3816,70 @@ def main():
         fallbacks=[CommandHandler('cancel', cancel)],
     )
     
+    # Add conversation handler for bulk imports
+    import_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('import', import_start)],
+        states={
+            IMPORT_FILE: [MessageHandler(filters.Document.ALL, import_file)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+    )
+    
     # Add handlers
     application.add_handler(CommandHandler('start', start))
     application.add_handler(add_conv_handler)
+    application.add_handler(import_conv_handler)
     application.add_handler(CommandHandler('get', get_proxy))
     application.add_handler(CommandHandler('del', delete_first))
     application.add_handler(CommandHandler('delall', delete_all))
     application.add_handler(CommandHandler('showall', show_all))
     application.add_handler(CommandHandler('checkall', manual_check_balances))
     application.add_handler(CommandHandler('list', list_countries))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    
-    # Set up periodic balance check (every 1 hour)
+    application.add_handler(CommandHandler('metrics', show_metrics))
+    application.add_handler(CommandHandler('trends', show_trends))
+    application.add_handler(CommandHandler('orders', export_orders))
+    application.add_handler(CommandHandler('profile', profile_command))
+    application.add_handler(CallbackQueryHandler(button_callback, pattern=r'^(page_\d+|noop)$'))
+    application.add_handler(CallbackQueryHandler(show_all_callback, pattern=r'^sa_(all|low|stale)_[np]_\d+$'))
+    
+    # Set up adaptive balance polling, first pass after 10 seconds
     job_queue = application.job_queue
-    job_queue.run_repeating(check_balances_task, interval=3600, first=10)  # Check every hour, first check after 10 seconds
+    job_queue.run_repeating(check_balances_task, interval=POLL_TICK, first=10)
+    if WRITE_BEHIND_INTERVAL > 0:
+        job_queue.run_repeating(flush_writes_task, interval=WRITE_BEHIND_INTERVAL, first=WRITE_BEHIND_INTERVAL)
+    job_queue.run_repeating(flush_ledger_task, interval=ORDER_LEDGER_FLUSH_INTERVAL, first=ORDER_LEDGER_FLUSH_INTERVAL)
+    job_queue.run_repeating(rollup_history_task, interval=HISTORY_ROLLUP_INTERVAL, first=60)
+    job_queue.run_repeating(refresh_registry_task, interval=REGISTRY_REFRESH_INTERVAL, first=REGISTRY_REFRESH_INTERVAL)
+    
+    return application
+
+
+async def start_updates(application: Application):
+    """Start receiving updates through the webhook listener or long polling"""
+    if WEBHOOK_URL:
+        path = WEBHOOK_PATH.strip('/')
+        await application.updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{path}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Receiving updates by webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{path}")
+    else:
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("Receiving updates by long polling")
+    logger.info(f"Processing up to {CONCURRENT_UPDATES} update(s) concurrently")
+
+
+def main():
+    """Start the bot"""
+    # Replace with your bot token
+    BOT_TOKEN = "8226555654:AAEx9UB1-lDoHA5_9I1F55ISU-fkC_Z0Kxk"
+    
+    application = build_application(BOT_TOKEN)
     
     # Start the bot
     logger.info("Bot started successfully!")
@@ -1018,8 +3888,10 @@ def main():
     try:
         loop = asyncio.get_event_loop()
         loop.run_until_complete(application.initialize())
+        # run_polling() normally calls these hooks; the manual loop has to do it itself
+        loop.run_until_complete(application.post_init(application))
         loop.run_until_complete(application.start())
-        loop.run_until_complete(application.updater.start_polling(allowed_updates=Update.ALL_TYPES))
+        loop.run_until_complete(start_updates(application))
         
         # Keep the application running
         stop_signal = asyncio.Future()
@@ -1031,6 +3903,7 @@ def main():
             loop.run_until_complete(application.updater.stop())
             loop.run_until_complete(application.stop())
             loop.run_until_complete(application.shutdown())
+            loop.run_until_complete(application.post_shutdown(application))
     except Exception as e:
         logger.error(f"Critical error: {e}", exc_info=True)
 
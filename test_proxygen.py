@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Regression tests for proxygen.py, run against bench_proxygen's FakeOwlAPI
+
+    python -m unittest test_proxygen
+"""
+
+import asyncio
+import unittest
+
+# Importing the benchmark moves into a disposable directory before proxygen
+# opens its SQLite file
+from bench_proxygen import FakeOwlAPI, proxygen
+
+
+class FailoverTest(unittest.IsolatedAsyncioTestCase):
+    """create_with_failover against drained tokens"""
+
+    async def asyncSetUp(self):
+        self.api = FakeOwlAPI(latency=0.0, jitter=0.0)
+        await self.api.start()
+        proxygen.BALANCE_ENDPOINT = f"{self.api.base_url}/queryCurrentTrafficBalance"
+        proxygen.CREATE_PROXY_ENDPOINT = f"{self.api.base_url}/createProxy"
+        await proxygen.registry.delete_all()
+        proxygen.ProxyAPI._token_breakers.clear()
+        proxygen.ProxyAPI._endpoint_breakers.clear()
+        proxygen.token_health._stats.clear()
+
+    async def asyncTearDown(self):
+        await proxygen.ProxyAPI.shutdown()
+        await self.api.stop()
+
+    async def test_drained_token_fails_over(self):
+        drained = await proxygen.registry.add('drained-token', 'drained-user')
+        await proxygen.registry.add('healthy-token', 'healthy-user')
+        self.api.balances['drained-token'] = 0
+
+        for _ in range(4):
+            proxy_data, record = await proxygen.create_with_failover('US', 2)
+            self.assertEqual(len(proxy_data), 2)
+            self.assertEqual(record.token, 'healthy-token')
+
+        self.assertGreater(proxygen.ProxyAPI._token_breakers['drained-token'].failures, 0)
+        self.assertIsNone(drained.next_check_at)
+
+    async def test_rejected_by_every_token_is_not_held_against_them(self):
+        for i in range(2):
+            await proxygen.registry.add(f'drained-token-{i}', f'drained-user-{i}')
+            self.api.balances[f'drained-token-{i}'] = 0
+
+        proxy_data, record = await proxygen.create_with_failover('US', 2)
+        self.assertIsNone(proxy_data)
+        self.assertIsNone(record)
+        self.assertEqual(self.api.calls['createProxy'], 2)
+        for i in range(2):
+            self.assertEqual(proxygen.ProxyAPI._token_breakers[f'drained-token-{i}'].failures, 0)
+
+
+class SweepLockTest(unittest.IsolatedAsyncioTestCase):
+    """sweep_balances ownership of the balance_sweep lock"""
+
+    async def asyncSetUp(self):
+        self.api = FakeOwlAPI(latency=0.05, jitter=0.0)
+        await self.api.start()
+        proxygen.BALANCE_ENDPOINT = f"{self.api.base_url}/queryCurrentTrafficBalance"
+        proxygen.CREATE_PROXY_ENDPOINT = f"{self.api.base_url}/createProxy"
+        await proxygen.registry.delete_all()
+        for i in range(3):
+            await proxygen.registry.add(f'sweep-token-{i}', f'sweep-user-{i}')
+
+    async def asyncTearDown(self):
+        await proxygen.ProxyAPI.shutdown()
+        await self.api.stop()
+
+    async def test_one_sweep_per_process(self):
+        first = asyncio.ensure_future(proxygen.sweep_balances(proxygen.registry.all()))
+        await asyncio.sleep(0.01)
+
+        self.assertIsNone(await proxygen.sweep_balances(proxygen.registry.all()))
+        self.assertFalse(await proxygen.db.acquire_lock('balance_sweep', owner='other-host:1'))
+
+        stats = await first
+        self.assertEqual(stats['checked'], 3)
+        self.assertTrue(await proxygen.db.acquire_lock('balance_sweep', owner='other-host:1'))
+        await proxygen.db.release_lock('balance_sweep', owner='other-host:1')
+
+
+if __name__ == '__main__':
+    unittest.main()